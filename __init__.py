@@ -2,31 +2,676 @@ import os
 import sys
 import json
 import hashlib
+import hmac
 import secrets
 import time
+import heapq
+import bisect
+import sqlite3
+import queue
+import gzip
+import shutil
+import re
+import abc
+import atexit
 import asyncio
 import functools
 import base64
 import stat
+import zlib
+import math
+import struct
+import threading
+import tempfile
+import contextlib
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web
 from server import PromptServer
 
+try:
+    import folder_paths
+except ImportError:
+    folder_paths = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ==================== JSON编解码 ====================
+
+# 工作流JSON可达数MB，安装了 orjson / msgspec 时用它们解析和序列化，否则使用标准库
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    import msgspec
+    HAS_MSGSPEC = True
+except ImportError:
+    HAS_MSGSPEC = False
+
+def available_json_codecs():
+    """当前环境可用的JSON编解码器（按优先级从低到高）"""
+    names = ["json"]
+    if HAS_MSGSPEC:
+        names.append("msgspec")
+    if HAS_ORJSON:
+        names.append("orjson")
+    return names
+
+def _select_json_codec(name):
+    available = available_json_codecs()
+    if name == "auto":
+        return available[-1]
+    if name not in available:
+        print(f"\033[93m[Workflow Protector] JSON编解码器 {name} 不可用，使用 {available[-1]}\033[0m")
+        return available[-1]
+    return name
+
+# auto 依次优先 orjson、msgspec、标准库
+JSON_CODEC = _select_json_codec(os.environ.get("WP_JSON_CODEC", "auto"))
+
+class NonFiniteFloat(float):
+    """json_loads 解析出的 NaN / Infinity（包括 1e400 这类溢出的数）
+    
+    orjson / msgspec 会把非有限浮点数静默写成 null；这类值以 float 子类保存，
+    快速编码器不认识该类型而交给标准库，原样写回 NaN / Infinity。
+    """
+    __slots__ = ()
+
+def _parse_constant(name):
+    return NonFiniteFloat(name)
+
+def _parse_float(text):
+    value = float(text)
+    return value if math.isfinite(value) else NonFiniteFloat(value)
+
+def _has_non_finite(obj):
+    """obj 中是否有 NaN / Infinity 浮点数"""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif isinstance(item, float) and not math.isfinite(item):
+            return True
+    return False
+
+def json_dumps(obj, keep_non_finite=False):
+    """序列化为UTF-8 JSON字节（非ASCII字符原样输出）
+    
+    快速编码器不支持的值（超出64位的整数、NonFiniteFloat 等）交给标准库。
+    keep_non_finite 用于加密前序列化工作流：普通 float 的 NaN / Infinity 也会被
+    快速编码器写成 null，输出中含 null 时遍历一次 obj，有非有限数则改用标准库。
+    """
+    data = None
+    if JSON_CODEC == "orjson":
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    elif JSON_CODEC == "msgspec":
+        try:
+            data = msgspec.json.encode(obj, enc_hook=_reject_json_type)
+        except Exception:
+            pass
+    if data is not None and not (keep_non_finite and b"null" in data and _has_non_finite(obj)):
+        return data
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+def _reject_json_type(obj):
+    raise TypeError(f"unsupported type: {type(obj).__name__}")
+
+def json_loads(data):
+    """解析JSON（str 或 bytes）
+    
+    快速解析器拒绝的内容（NaN、Infinity 等标准库可接受的写法）交给标准库再试一次，
+    其中的非有限数解析为 NonFiniteFloat，再次序列化时保持不变。
+    真正无效的数据仍抛出 json.JSONDecodeError / UnicodeDecodeError，与标准库行为一致。
+    """
+    if JSON_CODEC == "orjson":
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    elif JSON_CODEC == "msgspec":
+        try:
+            return msgspec.json.decode(data)
+        except msgspec.DecodeError:
+            pass
+    return json.loads(data, parse_constant=_parse_constant, parse_float=_parse_float)
+
+async def read_json(request):
+    """读取请求体JSON（代替 request.json()）"""
+    return json_loads(await request.read())
+
+def json_response(data, status=200, headers=None):
+    """JSON响应（代替 web.json_response）"""
+    return web.Response(
+        body=json_dumps(data), status=status, headers=headers,
+        content_type="application/json", charset="utf-8"
+    )
+
 # ==================== 加密模块 ====================
 
 try:
     from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
     from cryptography.hazmat.backends import default_backend
     from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
     HAS_CRYPTO = True
 except ImportError:
     HAS_CRYPTO = False
     print("\033[93m[Workflow Protector] 警告: 未安装cryptography库，使用内置加密\033[0m")
     print("\033[93m[Workflow Protector] 建议运行: pip install cryptography\033[0m")
 
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+try:
+    import brotli
+    HAS_BROTLI = True
+    # brotli >= 1.1 的 process() 支持 output_buffer_limit，解密时才能限制解压输出
+    HAS_BROTLI_LIMIT = hasattr(brotli.Decompressor, "can_accept_more_data")
+except ImportError:
+    HAS_BROTLI = False
+    HAS_BROTLI_LIMIT = False
+
+# 加密前压缩：工作流JSON重复度很高（节点类型、控件名、连线），压缩后文件可显著减小
+DEFAULT_COMPRESSION = os.environ.get("WP_COMPRESSION", "zlib")
+COMPRESSION_LEVEL = os.environ.get("WP_COMPRESSION_LEVEL")
+_COMPRESSION_LEVELS = {"zlib": (6, 0, 9), "zstd": (3, 1, 22), "brotli": (5, 0, 11)}  # (默认, 最小, 最大)
+# 解压输出上限（字节），防止压缩炸弹；0 表示不限制
+MAX_DECOMPRESSED_BYTES = int(os.environ.get("WP_MAX_DECOMPRESSED_BYTES", str(512 * 1024 * 1024)))
+
+def available_compressions():
+    """当前环境可用的压缩算法"""
+    names = ["none", "zlib"]
+    if HAS_ZSTD:
+        names.append("zstd")
+    if HAS_BROTLI:
+        names.append("brotli")
+    return names
+
+def _compression_level(algorithm, level):
+    default, low, high = _COMPRESSION_LEVELS[algorithm]
+    if level is None:
+        level = COMPRESSION_LEVEL
+    if level is None or level == "":
+        return default
+    return min(high, max(low, int(level)))
+
+def new_compressor(algorithm, level=None):
+    """创建流式压缩器，返回 (process, finish) 两个函数"""
+    if algorithm == "zlib":
+        obj = zlib.compressobj(_compression_level("zlib", level))
+        return obj.compress, obj.flush
+    if algorithm == "zstd" and HAS_ZSTD:
+        obj = zstandard.ZstdCompressor(level=_compression_level("zstd", level)).compressobj()
+        return obj.compress, obj.flush
+    if algorithm == "brotli" and HAS_BROTLI:
+        obj = brotli.Compressor(quality=_compression_level("brotli", level))
+        return obj.process, obj.finish
+    raise ValueError(f"不支持的压缩算法: {algorithm}")
+
+# zstd 解压时每次喂入的压缩数据量。每个 zstd 块至少4字节、解压后至多128 KiB，
+# 单次调用的输出因此不超过约 (256 / 4 + 1) × 128 KiB ≈ 8 MiB
+_ZSTD_FEED_SIZE = 256
+
+def new_decompressor(algorithm, max_size=None):
+    """创建流式解压器，返回 (process, finish) 两个函数
+    
+    累计输出超过 max_size（默认 MAX_DECOMPRESSED_BYTES）时抛出 DecryptionError，
+    单次调用的输出在生成前就受到限制：zlib 用 max_length，brotli 用 output_buffer_limit，
+    zstd 没有输出限制参数，按 _ZSTD_FEED_SIZE 分段喂入。
+    已安装的 brotli 不支持 output_buffer_limit（< 1.1）时拒绝解压 brotli 数据（DecryptionError）。
+    """
+    if max_size is None:
+        max_size = MAX_DECOMPRESSED_BYTES
+    total = 0
+    
+    def check(output):
+        nonlocal total
+        total += len(output)
+        if max_size > 0 and total > max_size:
+            raise DecryptionError(f"解密失败: 解压后数据超过上限 ({max_size} 字节)")
+        return output
+    
+    def remaining():
+        # 多取1字节，超出上限时由 check() 发现
+        return max_size - total + 1
+    
+    if algorithm == "zlib":
+        obj = zlib.decompressobj()
+        def process(data):
+            output = obj.decompress(data, remaining() if max_size > 0 else 0)
+            if obj.unconsumed_tail:
+                raise DecryptionError(f"解密失败: 解压后数据超过上限 ({max_size} 字节)")
+            return check(output)
+        return process, lambda: check(obj.flush())
+    if algorithm == "zstd" and HAS_ZSTD:
+        obj = zstandard.ZstdDecompressor().decompressobj()
+        def process(data):
+            if max_size <= 0:
+                return obj.decompress(data)
+            view = memoryview(data)
+            return b"".join(check(obj.decompress(view[i:i + _ZSTD_FEED_SIZE]))
+                            for i in range(0, len(view), _ZSTD_FEED_SIZE))
+        return process, lambda: check(obj.flush())
+    if algorithm == "brotli" and HAS_BROTLI:
+        obj = brotli.Decompressor()
+        if max_size <= 0:
+            return obj.process, lambda: b""
+        if not HAS_BROTLI_LIMIT:
+            raise DecryptionError("解密失败: 解压brotli数据需要 brotli >= 1.1: pip install -U brotli")
+        def process(data):
+            parts = [check(obj.process(data, output_buffer_limit=remaining()))]
+            # 输出缓冲区满时解压器暂停，取完剩余输出才能继续喂入
+            while not obj.can_accept_more_data():
+                parts.append(check(obj.process(b"", output_buffer_limit=remaining())))
+            return b"".join(parts)
+        return process, lambda: b""
+    raise ValueError(f"不支持的压缩算法: {algorithm}")
+
+def compress_bytes(data, algorithm, level=None):
+    """整体压缩"""
+    process, finish = new_compressor(algorithm, level)
+    return process(data) + finish()
+
+def decompress_bytes(data, algorithm):
+    """整体解压（输出上限同 new_decompressor）"""
+    process, finish = new_decompressor(algorithm)
+    return process(data) + finish()
+
+DERIVED_KEY_CACHE_SIZE = max(0, int(os.environ.get("WP_KEY_CACHE_SIZE", "64")))
+DERIVED_KEY_CACHE_TTL = max(0, int(os.environ.get("WP_KEY_CACHE_TTL", "600")))
+
+class DerivedKeyCache:
+    """派生密钥缓存（LRU + TTL）
+    
+    以 HMAC(进程随机密钥, salt + password) 作为缓存键，不在内存中保留明文密码；
+    条目被淘汰或清空时会覆写密钥内容。
+    """
+    
+    def __init__(self, max_entries=DERIVED_KEY_CACHE_SIZE, ttl=DERIVED_KEY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # {cache_id: (bytearray(key), expires)}
+        self._lock = threading.Lock()
+        self._secret = secrets.token_bytes(32)
+    
+    def _cache_id(self, password, salt):
+        message = salt.encode('utf-8') + b"\0" + password.encode('utf-8')
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+    
+    @staticmethod
+    def _wipe(key_buffer):
+        key_buffer[:] = bytes(len(key_buffer))
+    
+    def get(self, password, salt):
+        """查找缓存的密钥，未命中或已过期时返回None"""
+        if self.max_entries <= 0:
+            return None
+        
+        cache_id = self._cache_id(password, salt)
+        with self._lock:
+            entry = self._entries.get(cache_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            key_buffer, expires = entry
+            if time.time() > expires:
+                del self._entries[cache_id]
+                self._wipe(key_buffer)
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(cache_id)
+            self.hits += 1
+            return bytes(key_buffer)
+    
+    def put(self, password, salt, key):
+        """缓存派生密钥，超出容量时淘汰最久未使用的条目"""
+        if self.max_entries <= 0:
+            return
+        
+        cache_id = self._cache_id(password, salt)
+        with self._lock:
+            old = self._entries.pop(cache_id, None)
+            if old is not None:
+                self._wipe(old[0])
+            self._entries[cache_id] = (bytearray(key), time.time() + self.ttl)
+            
+            while len(self._entries) > self.max_entries:
+                _, (key_buffer, _) = self._entries.popitem(last=False)
+                self._wipe(key_buffer)
+    
+    def clear(self):
+        """清空缓存并覆写所有密钥"""
+        with self._lock:
+            for key_buffer, _ in self._entries.values():
+                self._wipe(key_buffer)
+            self._entries.clear()
+    
+    def stats(self):
+        """获取缓存统计"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+_derived_key_cache = DerivedKeyCache()
+
+class KeyRing:
+    """批量处理用的密钥环
+    
+    同一 (密码, 盐) 在一个批次内只派生一次；shared_salt 时所有新文件共用同一个盐，
+    整批加密只需要一次PBKDF2（每个文件仍使用独立的随机IV/nonce）。
+    """
+    
+    def __init__(self, password, shared_salt=False, salt=None, keys=None):
+        self.password = password
+        self.salt = salt or (secrets.token_hex(16) if shared_salt else None)
+        self.keys = dict(keys or {})
+        self.derivations = 0
+        self._lock = threading.Lock()
+        self._salt_locks = {}
+    
+    def new_salt(self):
+        """新文件使用的盐"""
+        return self.salt or secrets.token_hex(16)
+    
+    def key_for(self, salt):
+        """获取盐对应的密钥，并发调用时只派生一次"""
+        with self._lock:
+            if salt in self.keys:
+                return self.keys[salt]
+            salt_lock = self._salt_locks.setdefault(salt, threading.Lock())
+        
+        with salt_lock:
+            with self._lock:
+                if salt in self.keys:
+                    return self.keys[salt]
+            key = WorkflowEncryption.derive_key(self.password, salt)
+            with self._lock:
+                self.keys[salt] = key
+                self.derivations += 1
+            return key
+
+# V2 格式：分块 AES-GCM，可边读边加解密
+STREAM_MAGIC = b"WPV2"
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_HEADER = 64 * 1024
+STREAM_MAX_CHUNK = 16 * 1024 * 1024
+_FRAME_FINAL = 0x80000000
+
+def _select_encryption_version(value):
+    default = 2 if HAS_CRYPTO else 1
+    if value is None:
+        return default
+    try:
+        version = int(value)
+    except ValueError:
+        version = None
+    if version not in (1, 2) or version > default:
+        print(f"\033[93m[Workflow Protector] 无效的加密格式版本 {value}，使用 V{default}\033[0m")
+        return default
+    return version
+
+DEFAULT_ENCRYPTION_VERSION = _select_encryption_version(os.environ.get("WP_ENCRYPTION_VERSION"))
+
+class DecryptionError(Exception):
+    """解密失败（密码错误、数据损坏或格式无效）"""
+    pass
+
+# 头部中允许修改、不参与认证的字段
+# keys 中是被包装的数据密钥，更换密码时改写；数据密钥本身由参与认证的 kcv 绑定
+_UNAUTHENTICATED_HEADER_FIELDS = ("hint", "keys")
+
+# 密钥校验值：由派生密钥计算的短标签，派生完密钥即可判断密码是否正确，无需解密数据
+_KCV_LABEL = b"COMFYUI_WORKFLOW_PROTECTOR_KCV"
+_KCV_BYTES = 8
+
+def key_check_value(key):
+    """计算密钥校验值（HMAC-SHA256 截断，base64），不泄露密钥本身"""
+    digest = hmac.new(key, _KCV_LABEL, hashlib.sha256).digest()[:_KCV_BYTES]
+    return base64.b64encode(digest).decode('utf-8')
+
+def key_matches(key, kcv):
+    """密钥是否与校验值一致；没有校验值的旧文件视为一致"""
+    if not kcv:
+        return True
+    return hmac.compare_digest(key_check_value(key), kcv)
+
+# 包装数据密钥：数据由随机数据密钥加密，数据密钥再由各密码派生的包装密钥加密后写入头部 keys，
+# 更换或添加密码只需改写头部，不必重新加密数据块
+_WRAP_LABEL = b"COMFYUI_WORKFLOW_PROTECTOR_DEK"
+_WRAPPED_KEY_BYTES = 12 + 32 + 16
+WRAPPED_KEYS_MAX = 8
+
+def _stream_header_aad(header):
+    """V2 头部的规范化字节，作为每个数据块的附加认证数据"""
+    return json.dumps(
+        {k: v for k, v in header.items() if k not in _UNAUTHENTICATED_HEADER_FIELDS},
+        sort_keys=True, separators=(",", ":")
+    ).encode('utf-8')
+
+def _chunk_nonce(prefix, counter, final):
+    """块 nonce = 7字节随机前缀 + 4字节块序号 + 1字节结束标记"""
+    if counter >= 0xFFFFFFFF:
+        raise DecryptionError("数据块数量超出限制")
+    return prefix + counter.to_bytes(4, 'big') + (b"\x01" if final else b"\x00")
+
+class StreamEncryptor:
+    """V2 分块加密器
+    
+    明文按 header["chunk"] 切块，每块独立做 AES-GCM 加密。nonce 中包含块序号和
+    结束标记，块被截断、重排或替换都会导致认证失败。
+    """
+    
+    def __init__(self, key, header, compression_level=None):
+        self._aead = AESGCM(key)
+        self._aad = _stream_header_aad(header)
+        self._prefix = base64.b64decode(header["nonce"])
+        self._chunk_size = header["chunk"]
+        self._counter = 0
+        self._buffer = bytearray()
+        self._compressor = None
+        if header.get("compression"):
+            self._compressor = new_compressor(header["compression"], compression_level)
+    
+    def _seal(self, data, final):
+        nonce = _chunk_nonce(self._prefix, self._counter, final)
+        self._counter += 1
+        return self._aead.encrypt(nonce, bytes(data), self._aad)
+    
+    def update(self, data):
+        """追加明文，返回已加密完成的数据块列表"""
+        if self._compressor:
+            data = self._compressor[0](data)
+        self._buffer += data
+        sealed = []
+        # 至少保留一个字节，保证最后一块总能带上结束标记
+        while len(self._buffer) > self._chunk_size:
+            sealed.append(self._seal(self._buffer[:self._chunk_size], False))
+            del self._buffer[:self._chunk_size]
+        return sealed
+    
+    def finalize(self):
+        """加密剩余明文，返回带结束标记的最后一块"""
+        if self._compressor:
+            self._buffer += self._compressor[1]()
+        sealed = self._seal(self._buffer, True)
+        self._buffer = bytearray()
+        return sealed
+
+class StreamDecryptor:
+    """V2 分块解密器，与 StreamEncryptor 对应"""
+    
+    def __init__(self, key, header):
+        self._aead = AESGCM(key)
+        self._aad = _stream_header_aad(header)
+        self._prefix = base64.b64decode(header["nonce"])
+        self._counter = 0
+        self.finished = False
+        self._decompressor = None
+        if header.get("compression"):
+            try:
+                self._decompressor = new_decompressor(header["compression"])
+            except ValueError as e:
+                raise DecryptionError(str(e))
+    
+    def decrypt_chunk(self, sealed, final):
+        """解密并校验一个数据块"""
+        if self.finished:
+            raise DecryptionError("解密失败: 结束块之后仍有数据")
+        
+        nonce = _chunk_nonce(self._prefix, self._counter, final)
+        try:
+            data = self._aead.decrypt(nonce, bytes(sealed), self._aad)
+        except InvalidTag:
+            raise DecryptionError("解密失败: 密码错误或文件损坏")
+        
+        self._counter += 1
+        self.finished = final
+        
+        if self._decompressor:
+            try:
+                data = self._decompressor[0](data)
+                if final:
+                    data += self._decompressor[1]()
+            except DecryptionError:
+                raise
+            except Exception:
+                raise DecryptionError("解密失败: 解压数据出错")
+        return data
+
+def _decode_stream_header(header_bytes):
+    """解析V2二进制流头部JSON，并校验解密要用到的字段"""
+    try:
+        header = json.loads(header_bytes.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise DecryptionError("无效的V2头部")
+    if not isinstance(header, dict) or not _valid_stream_header(header):
+        raise DecryptionError("无效的V2头部")
+    return header
+
+def _valid_stream_header(header):
+    """字段缺失或类型错误时返回False，避免解密时抛出 KeyError / TypeError"""
+    try:
+        if len(base64.b64decode(header["nonce"], validate=True)) != 7:
+            return False
+    except (KeyError, TypeError, ValueError):
+        return False
+    
+    for field in ("kcv", "compression"):
+        if field in header and not isinstance(header[field], str):
+            return False
+    chunk = header.get("chunk", STREAM_CHUNK_SIZE)
+    if type(chunk) is not int or not 0 < chunk <= STREAM_MAX_CHUNK:
+        return False
+    
+    if "keys" in header:
+        # 包装密钥本身在解包时校验
+        entries = header["keys"]
+        return isinstance(entries, list) and all(
+            isinstance(e, dict) and isinstance(e.get("salt"), str) and isinstance(e.get("key"), str)
+            for e in entries
+        )
+    return isinstance(header.get("salt"), str)
+
+def read_stream_header(container):
+    """读取完整二进制容器的头部，返回 (header, 数据帧起始位置)"""
+    if len(container) < 8 or container[:4] != STREAM_MAGIC:
+        raise DecryptionError("不是V2加密数据流")
+    header_len = struct.unpack(">I", container[4:8])[0]
+    if header_len > STREAM_MAX_HEADER or len(container) < 8 + header_len:
+        raise DecryptionError("无效的V2头部")
+    return _decode_stream_header(bytes(container[8:8 + header_len])), 8 + header_len
+
+class StreamParser:
+    """V2 二进制流解析器（推送式，可直接喂入网络或文件读到的任意分片）
+    
+    格式: b"WPV2" | 头部长度(uint32) | 头部JSON | 帧*
+    帧:   长度(uint32，最高位为结束标记) | 密文块
+    """
+    
+    def __init__(self):
+        self.header = None
+        self._buffer = bytearray()
+        self._done = False
+    
+    def feed(self, data):
+        """喂入数据，返回解析出的事件列表:
+        ("header", header) 或 ("chunk", sealed, final)
+        """
+        self._buffer += data
+        events = []
+        
+        if self.header is None:
+            if len(self._buffer) < 8:
+                return events
+            if bytes(self._buffer[:4]) != STREAM_MAGIC:
+                raise DecryptionError("不是V2加密数据流")
+            header_len = struct.unpack(">I", self._buffer[4:8])[0]
+            if header_len > STREAM_MAX_HEADER:
+                raise DecryptionError("无效的V2头部")
+            if len(self._buffer) < 8 + header_len:
+                return events
+            self.header = _decode_stream_header(bytes(self._buffer[8:8 + header_len]))
+            del self._buffer[:8 + header_len]
+            events.append(("header", self.header))
+        
+        while len(self._buffer) >= 4:
+            if self._done:
+                raise DecryptionError("解密失败: 结束块之后仍有数据")
+            frame = struct.unpack(">I", self._buffer[:4])[0]
+            length = frame & ~_FRAME_FINAL
+            if length > STREAM_MAX_CHUNK + 16:
+                raise DecryptionError("无效的数据块长度")
+            if len(self._buffer) < 4 + length:
+                break
+            final = bool(frame & _FRAME_FINAL)
+            events.append(("chunk", bytes(self._buffer[4:4 + length]), final))
+            del self._buffer[:4 + length]
+            self._done = final
+        
+        return events
+    
+    def close(self):
+        """输入结束时调用，数据不完整则抛出异常"""
+        if not self._done or self._buffer:
+            raise DecryptionError("解密失败: 数据不完整")
+
 class WorkflowEncryption:
     """工作流加密类"""
     
     MAGIC_HEADER = "COMFYUI_PROTECTED_WORKFLOW_V1"
+    MAGIC_HEADER_V2 = "COMFYUI_PROTECTED_WORKFLOW_V2"
+    HINT = "此工作流已加密保护，需要安装 Workflow Protector 插件并输入正确密码才能使用"
     
     @staticmethod
     def derive_key(password, salt, machine_key=""):
@@ -43,19 +688,47 @@ class WorkflowEncryption:
         return key
     
     @staticmethod
-    def encrypt_workflow(workflow_json, password, machine_key=""):
-        """加密工作流（便携模式，可跨机器使用）"""
-        salt = secrets.token_hex(16)
-        iv = secrets.token_bytes(16)
-        key = WorkflowEncryption.derive_key(password, salt)
+    def encrypt_workflow(workflow_json, password, machine_key="", version=None,
+                         compression=None, compression_level=None, keyring=None):
+        """加密工作流（便携模式，可跨机器使用）
+        
+        version 为空时使用 DEFAULT_ENCRYPTION_VERSION：
+        安装了cryptography时为V2分块格式，否则为V1。
+        compression 为空时V2默认使用 DEFAULT_COMPRESSION，V1默认不压缩（保持与旧版插件兼容）。
+        keyring 用于批量处理时复用已派生的密钥。
+        """
+        if version is None:
+            version = DEFAULT_ENCRYPTION_VERSION
+        if compression is None:
+            compression = DEFAULT_COMPRESSION if version == 2 else "none"
         
-        # 将工作流转为JSON字符串
+        # 将工作流转为JSON字节
         if isinstance(workflow_json, dict):
-            data = json.dumps(workflow_json, ensure_ascii=False)
+            data_bytes = json_dumps(workflow_json, keep_non_finite=True)
         else:
-            data = workflow_json
+            data_bytes = workflow_json.encode('utf-8')
+        
+        if version == 2:
+            encrypted_workflow = WorkflowEncryption._encrypt_v2(
+                data_bytes, password, compression, compression_level, keyring
+            )
+        else:
+            encrypted_workflow = WorkflowEncryption._encrypt_v1(
+                data_bytes, password, compression, compression_level, keyring
+            )
+        
+        # 添加一个假的工作流结构，让没有插件的ComfyUI显示提示信息
+        encrypted_workflow.update(WorkflowEncryption._decoy_workflow())
+        return encrypted_workflow
+    
+    @staticmethod
+    def _encrypt_v1(data_bytes, password, compression="none", compression_level=None, keyring=None):
+        """V1格式：整体 AES-CBC（或XOR后备）加密"""
+        if compression != "none":
+            data_bytes = compress_bytes(data_bytes, compression, compression_level)
         
-        data_bytes = data.encode('utf-8')
+        salt, key = WorkflowEncryption._new_salt_key(password, keyring)
+        iv = secrets.token_bytes(16)
         
         # 记录使用的加密方法
         cipher_method = "AES-CBC" if HAS_CRYPTO else "XOR"
@@ -72,14 +745,6 @@ class WorkflowEncryption:
             # 简单的XOR加密作为后备（不如AES安全，但也能用）
             encrypted = WorkflowEncryption._xor_encrypt(data_bytes, key, iv)
         
-        # 构建加密后的文件结构
-        # 添加一个假的工作流结构，让没有插件的ComfyUI显示提示信息
-        note_text = (
-            "⚠️ 此工作流已加密保护 ⚠️\n\n"
-            "需要安装 Workflow Protector 插件才能使用。\n\n"
-            "安装插件后，重新拖入此文件即可解密。"
-        )
-        
         encrypted_workflow = {
             "_protected": WorkflowEncryption.MAGIC_HEADER,
             "_version": 1,
@@ -87,8 +752,43 @@ class WorkflowEncryption:
             "_salt": salt,
             "_iv": base64.b64encode(iv).decode('utf-8'),
             "_data": base64.b64encode(encrypted).decode('utf-8'),
-            "_hint": "此工作流已加密保护，需要安装 Workflow Protector 插件并输入正确密码才能使用",
-            # 假工作流 - 让没有插件的ComfyUI显示提示
+            "_kcv": key_check_value(key),
+            "_hint": WorkflowEncryption.HINT,
+        }
+        if compression != "none":
+            encrypted_workflow["_compression"] = compression
+        return encrypted_workflow
+    
+    @staticmethod
+    def _encrypt_v2(data_bytes, password, compression="none", compression_level=None, keyring=None):
+        """V2格式：分块 AES-GCM 加密，数据块以base64列表保存"""
+        if not HAS_CRYPTO:
+            raise ValueError("V2加密格式需要cryptography库: pip install cryptography")
+        
+        key, header = WorkflowEncryption.new_stream_header(password, compression, keyring)
+        encryptor = StreamEncryptor(key, header, compression_level)
+        chunks = encryptor.update(data_bytes)
+        chunks.append(encryptor.finalize())
+        
+        return {
+            "_protected": WorkflowEncryption.MAGIC_HEADER_V2,
+            "_version": 2,
+            "_cipher": header["cipher"],
+            "_header": header,
+            "_chunks": [base64.b64encode(c).decode('utf-8') for c in chunks],
+            "_hint": WorkflowEncryption.HINT,
+        }
+    
+    @staticmethod
+    def _decoy_workflow():
+        """占位工作流 - 让没有插件的ComfyUI显示提示"""
+        note_text = (
+            "⚠️ 此工作流已加密保护 ⚠️\n\n"
+            "需要安装 Workflow Protector 插件才能使用。\n\n"
+            "安装插件后，重新拖入此文件即可解密。"
+        )
+        
+        return {
             "last_node_id": 1,
             "last_link_id": 0,
             "nodes": [
@@ -112,25 +812,246 @@ class WorkflowEncryption:
             "extra": {},
             "version": 0.4
         }
+    
+    @staticmethod
+    def new_stream_header(password, compression="none", keyring=None):
+        """生成V2头部，返回 (数据密钥, header)
+        
+        数据密钥随机生成，用密码派生的包装密钥加密后写入头部 keys。
+        """
+        if compression not in available_compressions():
+            raise ValueError(f"不支持的压缩算法: {compression}")
+        
+        key = AESGCM.generate_key(bit_length=256)
+        header = {
+            "v": 2,
+            "cipher": "AES-GCM",
+            "kdf": "PBKDF2-SHA256",
+            "nonce": base64.b64encode(secrets.token_bytes(7)).decode('utf-8'),
+            "chunk": STREAM_CHUNK_SIZE,
+            "kcv": key_check_value(key),
+            "keys": [WorkflowEncryption.wrap_data_key(key, password, keyring)]
+        }
+        # 压缩算法写入头部，随头部一起参与认证
+        if compression != "none":
+            header["compression"] = compression
+        return key, header
+    
+    @staticmethod
+    def wrap_data_key(data_key, password, keyring=None):
+        """用密码派生的包装密钥加密数据密钥，返回头部 keys 中的一项"""
+        salt, kek = WorkflowEncryption._new_salt_key(password, keyring)
+        nonce = secrets.token_bytes(12)
+        wrapped = nonce + AESGCM(kek).encrypt(nonce, data_key, _WRAP_LABEL)
+        return {"salt": salt, "key": base64.b64encode(wrapped).decode('utf-8')}
+    
+    @staticmethod
+    def unwrap_data_key(header, password, keyring=None):
+        """用密码解开头部 keys 中的数据密钥
+        
+        依次尝试每一项，包装密钥的 GCM 认证失败说明不是这个密码。
+        解包成功即可确认密码正确，包装密钥此时写入缓存。
+        """
+        entries = header.get("keys")
+        if not isinstance(entries, list) or not entries or len(entries) > WRAPPED_KEYS_MAX:
+            raise DecryptionError("无效的V2头部")
+        
+        for entry in entries:
+            try:
+                salt = entry["salt"]
+                wrapped = base64.b64decode(entry["key"])
+            except (TypeError, KeyError, ValueError):
+                raise DecryptionError("无效的V2头部")
+            if not isinstance(salt, str) or len(wrapped) != _WRAPPED_KEY_BYTES:
+                raise DecryptionError("无效的V2头部")
+            
+            kek, kek_cached = WorkflowEncryption._lookup_key(password, salt, keyring)
+            try:
+                data_key = AESGCM(kek).decrypt(wrapped[:12], wrapped[12:], _WRAP_LABEL)
+            except InvalidTag:
+                continue
+            if not key_matches(data_key, header.get("kcv")):
+                raise DecryptionError("解密失败: 文件损坏")
+            if not kek_cached:
+                _derived_key_cache.put(password, salt, kek)
+            return data_key
+        
+        raise DecryptionError("解密失败: 密码错误")
+    
+    @staticmethod
+    def rekey_header(header, old_password, new_password, keep_old=False, keyring=None, new_keyring=None):
+        """用新密码重新包装数据密钥，返回新头部（数据块不变）
+        
+        keep_old 为 False 时只保留新密码，为 True 时在原有密码之外添加新密码。
+        """
+        data_key = WorkflowEncryption.unwrap_data_key(header, old_password, keyring)
+        keys = list(header["keys"]) if keep_old else []
+        if len(keys) >= WRAPPED_KEYS_MAX:
+            raise ValueError(f"每个文件最多 {WRAPPED_KEYS_MAX} 个密码")
+        keys.append(WorkflowEncryption.wrap_data_key(data_key, new_password, new_keyring))
+        
+        rekeyed = dict(header)
+        rekeyed["keys"] = keys
+        return rekeyed
+    
+    @staticmethod
+    def _new_salt_key(password, keyring=None):
+        """为新文件生成盐并派生密钥，返回 (salt, key)"""
+        if keyring is not None:
+            salt = keyring.new_salt()
+            return salt, keyring.key_for(salt)
+        salt = secrets.token_hex(16)
+        return salt, WorkflowEncryption.derive_key(password, salt)
+    
+    @staticmethod
+    def _lookup_key(password, salt, keyring=None):
+        """获取解密密钥，返回 (key, 是否无需再写入缓存)"""
+        if keyring is not None:
+            return keyring.key_for(salt), True
+        key = _derived_key_cache.get(password, salt)
+        if key is not None:
+            return key, True
+        return WorkflowEncryption.derive_key(password, salt), False
+    
+    @staticmethod
+    def stream_key(header, password, keyring=None):
+        """根据V2头部派生解密密钥，返回 (key, 是否无需再写入缓存)"""
+        if not HAS_CRYPTO:
+            raise DecryptionError("此工作流使用AES-GCM加密，请安装cryptography库: pip install cryptography")
+        if header.get("v") != 2 or header.get("cipher") != "AES-GCM":
+            raise DecryptionError("不支持的加密格式")
+        
+        if "keys" in header:
+            # 包装格式：包装密钥在解包成功时已写入缓存
+            return WorkflowEncryption.unwrap_data_key(header, password, keyring), True
+        
+        # 旧V2文件：数据直接由密码派生的密钥加密
+        key, key_cached = WorkflowEncryption._lookup_key(password, header["salt"], keyring)
+        # 头部带校验值时，密码错误在派生密钥后立即返回，不再解密任何数据块
+        if not key_matches(key, header.get("kcv")):
+            raise DecryptionError("解密失败: 密码错误")
+        return key, key_cached
+    
+    @staticmethod
+    def pack_stream_header(header):
+        """序列化V2二进制流头部"""
+        header_bytes = json.dumps(header, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+        return STREAM_MAGIC + struct.pack(">I", len(header_bytes)) + header_bytes
+    
+    @staticmethod
+    def pack_frame(sealed, final):
+        """序列化V2二进制流中的一个数据块"""
+        return struct.pack(">I", len(sealed) | (_FRAME_FINAL if final else 0)) + sealed
+    
+    @staticmethod
+    def iter_encrypt_stream(data_iter, password, compression=None, compression_level=None, keyring=None):
+        """逐段加密明文，生成V2二进制流（适合大文件/命令行）"""
+        if compression is None:
+            compression = DEFAULT_COMPRESSION
+        key, header = WorkflowEncryption.new_stream_header(password, compression, keyring)
+        encryptor = StreamEncryptor(key, header, compression_level)
+        header["hint"] = WorkflowEncryption.HINT
+        yield WorkflowEncryption.pack_stream_header(header)
+        for data in data_iter:
+            for sealed in encryptor.update(data):
+                yield WorkflowEncryption.pack_frame(sealed, False)
+        yield WorkflowEncryption.pack_frame(encryptor.finalize(), True)
+    
+    @staticmethod
+    def encrypt_to_container(workflow_json, password, compression=None, compression_level=None, keyring=None):
+        """加密为二进制容器（V2二进制流），省去base64和JSON封装的开销"""
+        if isinstance(workflow_json, dict):
+            data_bytes = json_dumps(workflow_json, keep_non_finite=True)
+        else:
+            data_bytes = workflow_json.encode('utf-8')
+        return b"".join(WorkflowEncryption.iter_encrypt_stream(
+            [data_bytes], password, compression, compression_level, keyring
+        ))
+    
+    @staticmethod
+    def envelope_to_container(encrypted_workflow):
+        """V2 JSON封装 → 二进制容器（只转换格式，不需要密码）"""
+        if encrypted_workflow.get("_protected") != WorkflowEncryption.MAGIC_HEADER_V2:
+            raise ValueError("只有V2格式可以转换为二进制容器")
+        
+        header = dict(encrypted_workflow["_header"])
+        header["hint"] = encrypted_workflow.get("_hint", WorkflowEncryption.HINT)
+        chunks = encrypted_workflow["_chunks"]
+        last = len(chunks) - 1
         
+        parts = [WorkflowEncryption.pack_stream_header(header)]
+        for i, chunk in enumerate(chunks):
+            parts.append(WorkflowEncryption.pack_frame(base64.b64decode(chunk), i == last))
+        return b"".join(parts)
+    
+    @staticmethod
+    def container_to_envelope(container):
+        """二进制容器 → V2 JSON封装（只转换格式，不需要密码）"""
+        parser = StreamParser()
+        chunks = [event[1] for event in parser.feed(container) if event[0] == "chunk"]
+        parser.close()
+        
+        header = dict(parser.header)
+        hint = header.pop("hint", WorkflowEncryption.HINT)
+        encrypted_workflow = {
+            "_protected": WorkflowEncryption.MAGIC_HEADER_V2,
+            "_version": 2,
+            "_cipher": header.get("cipher"),
+            "_header": header,
+            "_chunks": [base64.b64encode(c).decode('utf-8') for c in chunks],
+            "_hint": hint,
+        }
+        encrypted_workflow.update(WorkflowEncryption._decoy_workflow())
         return encrypted_workflow
     
     @staticmethod
-    def decrypt_workflow(encrypted_workflow, password, machine_key=""):
+    def iter_decrypt_stream(data_iter, password, keyring=None):
+        """逐段解析并解密V2二进制流，生成明文分片"""
+        parser = StreamParser()
+        decryptor = None
+        key_cached = True
+        
+        for data in data_iter:
+            for event in parser.feed(data):
+                if event[0] == "header":
+                    key, key_cached = WorkflowEncryption.stream_key(event[1], password, keyring)
+                    decryptor = StreamDecryptor(key, event[1])
+                    continue
+                
+                plaintext = decryptor.decrypt_chunk(event[1], event[2])
+                # 第一块通过认证即说明密码正确
+                if not key_cached:
+                    _derived_key_cache.put(password, parser.header["salt"], key)
+                    key_cached = True
+                yield plaintext
+        
+        parser.close()
+    
+    @staticmethod
+    def decrypt_workflow(encrypted_workflow, password, machine_key="", keyring=None):
         """解密工作流（便携模式，可跨机器使用）"""
         if not isinstance(encrypted_workflow, dict):
             return None, "无效的加密文件"
         
-        if encrypted_workflow.get("_protected") != WorkflowEncryption.MAGIC_HEADER:
+        magic = encrypted_workflow.get("_protected")
+        if magic == WorkflowEncryption.MAGIC_HEADER_V2:
+            return WorkflowEncryption._decrypt_v2(encrypted_workflow, password, keyring)
+        
+        if magic != WorkflowEncryption.MAGIC_HEADER:
             return None, "不是加密的工作流文件"
         
         try:
             salt = encrypted_workflow["_salt"]
-            iv = base64.b64decode(encrypted_workflow["_iv"])
-            encrypted_data = base64.b64decode(encrypted_workflow["_data"])
             cipher_method = encrypted_workflow.get("_cipher", "XOR")  # 默认XOR兼容旧版本
             
-            key = WorkflowEncryption.derive_key(password, salt)
+            # 同一文件重复打开时复用已派生的密钥
+            key, key_cached = WorkflowEncryption._lookup_key(password, salt, keyring)
+            # 带校验值的文件在解码数据之前就能判断密码错误
+            if not key_matches(key, encrypted_workflow.get("_kcv")):
+                return None, "解密失败: 密码错误"
+            
+            iv = base64.b64decode(encrypted_workflow["_iv"])
+            encrypted_data = base64.b64decode(encrypted_workflow["_data"])
             
             if cipher_method == "AES-CBC":
                 if not HAS_CRYPTO:
@@ -146,9 +1067,19 @@ class WorkflowEncryption:
                 # XOR解密
                 data_bytes = WorkflowEncryption._xor_decrypt(encrypted_data, key, iv)
             
-            workflow = json.loads(data_bytes.decode('utf-8'))
+            compression = encrypted_workflow.get("_compression", "none")
+            if compression != "none":
+                data_bytes = decompress_bytes(data_bytes, compression)
+            
+            workflow = json_loads(data_bytes)
+            
+            # 仅缓存解密成功的密钥，错误密码不会占用缓存
+            if not key_cached:
+                _derived_key_cache.put(password, salt, key)
             return workflow, None
             
+        except DecryptionError as e:
+            return None, str(e)
         except json.JSONDecodeError:
             return None, "解密失败: 密码错误"
         except UnicodeDecodeError:
@@ -156,21 +1087,127 @@ class WorkflowEncryption:
         except Exception as e:
             return None, "解密失败: 密码错误或文件损坏"
     
+    @staticmethod
+    def _decrypt_v2(encrypted_workflow, password, keyring=None):
+        """解密V2格式（JSON封装的分块数据）"""
+        try:
+            header = encrypted_workflow["_header"]
+            chunks = encrypted_workflow["_chunks"]
+            if not chunks:
+                return None, "无效的加密文件"
+            
+            key, key_cached = WorkflowEncryption.stream_key(header, password, keyring)
+            decryptor = StreamDecryptor(key, header)
+            
+            last = len(chunks) - 1
+            parts = [
+                decryptor.decrypt_chunk(base64.b64decode(chunk), i == last)
+                for i, chunk in enumerate(chunks)
+            ]
+            workflow = json_loads(b"".join(parts))
+            
+            if not key_cached:
+                _derived_key_cache.put(password, header["salt"], key)
+            return workflow, None
+            
+        except DecryptionError as e:
+            return None, str(e)
+        except Exception as e:
+            return None, "解密失败: 密码错误或文件损坏"
+    
+    @staticmethod
+    def rekey_workflow(encrypted_workflow, old_password, new_password, keep_old=False,
+                       keyring=None, new_keyring=None):
+        """更换加密工作流的密码，返回 (新的加密工作流, 错误信息)
+        
+        包装格式只改写头部 keys，数据块原样保留；
+        V1 和旧V2文件没有数据密钥，用旧密码完整解密后重新加密为包装格式。
+        keep_old 时保留原密码（即为文件添加一个密码）。
+        """
+        if not WorkflowEncryption.is_encrypted(encrypted_workflow):
+            return None, "不是加密的工作流文件"
+        
+        header = encrypted_workflow.get("_header")
+        try:
+            if isinstance(header, dict) and "keys" in header:
+                rekeyed = dict(encrypted_workflow)
+                rekeyed["_header"] = WorkflowEncryption.rekey_header(
+                    header, old_password, new_password, keep_old, keyring, new_keyring
+                )
+                return rekeyed, None
+        except (DecryptionError, ValueError) as e:
+            return None, str(e)
+        
+        if keep_old and not HAS_CRYPTO:
+            return None, "添加密码需要V2格式，请安装cryptography库: pip install cryptography"
+        
+        workflow, error = WorkflowEncryption.decrypt_workflow(encrypted_workflow, old_password, keyring=keyring)
+        if error:
+            return None, error
+        rekeyed = WorkflowEncryption.encrypt_workflow(
+            workflow, new_password, version=2 if keep_old else None, keyring=new_keyring
+        )
+        if keep_old:
+            return WorkflowEncryption.rekey_workflow(
+                rekeyed, new_password, old_password, keep_old=True, keyring=new_keyring
+            )
+        return rekeyed, None
+    
+    @staticmethod
+    def rekey_container(container, old_password, new_password, keep_old=False,
+                        keyring=None, new_keyring=None):
+        """更换二进制容器的密码，返回新的容器字节
+        
+        包装格式只替换头部，后面的数据帧直接复制；旧V2容器完整解密后重新加密。
+        """
+        header, offset = read_stream_header(container)
+        
+        if "keys" in header:
+            rekeyed = WorkflowEncryption.rekey_header(
+                header, old_password, new_password, keep_old, keyring, new_keyring
+            )
+            return WorkflowEncryption.pack_stream_header(rekeyed) + container[offset:]
+        
+        plaintext = b"".join(WorkflowEncryption.iter_decrypt_stream([container], old_password, keyring))
+        rekeyed = b"".join(WorkflowEncryption.iter_encrypt_stream(
+            [plaintext], new_password, header.get("compression", "none"), keyring=new_keyring
+        ))
+        if keep_old:
+            return WorkflowEncryption.rekey_container(
+                rekeyed, new_password, old_password, keep_old=True, keyring=new_keyring
+            )
+        return rekeyed
+    
     @staticmethod
     def is_encrypted(workflow):
         """检查工作流是否已加密"""
         if isinstance(workflow, dict):
-            return workflow.get("_protected") == WorkflowEncryption.MAGIC_HEADER
+            return workflow.get("_protected") in (
+                WorkflowEncryption.MAGIC_HEADER,
+                WorkflowEncryption.MAGIC_HEADER_V2
+            )
         return False
     
     @staticmethod
     def _xor_encrypt(data, key, iv):
-        """简单XOR加密（后备方案）"""
-        result = bytearray()
+        """简单XOR加密（后备方案）
+        
+        将 key+iv 平铺成与数据等长的密钥流后整块异或，输出与逐字节实现完全一致。
+        """
+        length = len(data)
+        if length == 0:
+            return b""
+        
         key_iv = key + iv
-        for i, byte in enumerate(data):
-            result.append(byte ^ key_iv[i % len(key_iv)])
-        return bytes(result)
+        
+        if HAS_NUMPY:
+            stream = np.resize(np.frombuffer(key_iv, dtype=np.uint8), length)
+            return (np.frombuffer(data, dtype=np.uint8) ^ stream).tobytes()
+        
+        repeats = -(-length // len(key_iv))
+        stream = (key_iv * repeats)[:length]
+        result = int.from_bytes(data, 'little') ^ int.from_bytes(stream, 'little')
+        return result.to_bytes(length, 'little')
     
     @staticmethod
     def _xor_decrypt(data, key, iv):
@@ -184,8 +1221,14 @@ CONFIG_FILE = os.path.join(CONFIG_DIR, ".wp_config")  # 隐藏文件
 KEY_FILE = os.path.join(CONFIG_DIR, ".wp_key")  # 加密密钥
 
 # 会话管理
-active_sessions = {}  # {token: {"expires": timestamp, "ip": ip}}
 SESSION_DURATION = 300  # 会话有效期5分钟
+SESSION_PURGE_INTERVAL = 30  # 过期会话清理间隔（秒）
+SESSION_BACKEND = os.environ.get("WP_SESSION_BACKEND", "memory")  # memory / sqlite
+SESSION_DB_FILE = os.path.join(CONFIG_DIR, ".wp_sessions.db")
+SESSION_CACHE_TTL = 1.0  # 共享后端的本地验证缓存有效期（秒）
+SESSION_TOUCH_INTERVAL = 1.0  # 同一会话两次刷新有效期的最小间隔（秒）
+STATUS_LONG_POLL_MAX = 60.0   # 状态长轮询的最长等待时间（秒）
+STATUS_POLL_INTERVAL = 2.0    # 长轮询期间重新检查状态的间隔（其他进程修改配置、会话过期不会唤醒等待）
 
 def get_or_create_key():
     """获取或创建加密密钥（每个安装唯一）"""
@@ -207,20 +1250,17 @@ def get_or_create_key():
     
     return key
 
-def load_config():
-    """加载配置"""
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                data = f.read()
-                try:
-                    decoded = base64.b64decode(data).decode('utf-8')
-                    return json.loads(decoded)
-                except:
-                    return json.loads(data)
-        except Exception as e:
-            print(f"\033[91m[Workflow Protector] 加载配置失败: {e}\033[0m")
-    
+# 配置缓存：进程内共享，仅在文件 inode/mtime/大小 变化时重新读取
+_config_lock = threading.RLock()
+_config_cache = {
+    "config": None,
+    "signature": None,
+    "hits": 0,
+    "misses": 0,
+}
+
+def _default_config():
+    """默认配置"""
     return {
         "password_hash": None,
         "password_salt": None,
@@ -231,24 +1271,198 @@ def load_config():
         "last_modified": None
     }
 
+def _config_signature():
+    """获取配置文件签名 (inode, mtime, size)，文件不存在时返回None"""
+    try:
+        st = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _read_config_file():
+    """从磁盘读取并解析配置，失败时返回None"""
+    try:
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            data = f.read()
+            try:
+                decoded = base64.b64decode(data).decode('utf-8')
+                return json.loads(decoded)
+            except:
+                return json.loads(data)
+    except Exception as e:
+        print(f"\033[91m[Workflow Protector] 加载配置失败: {e}\033[0m")
+    return None
+
+def load_config():
+    """加载配置（进程内缓存，文件变化时自动重新加载）"""
+    signature = _config_signature()
+    
+    with _config_lock:
+        cached = _config_cache["config"]
+        if cached is not None and signature == _config_cache["signature"]:
+            _config_cache["hits"] += 1
+            return dict(cached)
+        
+        _config_cache["misses"] += 1
+        config = _read_config_file() if signature is not None else None
+        if config is None:
+            # 文件损坏时继续使用上一次成功读取的配置，而不是静默回退到默认配置（无密码）
+            config = cached if cached is not None and signature is not None else _default_config()
+        
+        _config_cache["config"] = config
+        _config_cache["signature"] = signature
+        return dict(config)
+
+def get_config_cache_stats():
+    """获取配置缓存命中统计"""
+    with _config_lock:
+        return {
+            "hits": _config_cache["hits"],
+            "misses": _config_cache["misses"],
+            "loaded": _config_cache["config"] is not None
+        }
+
+# 写配置时的锁：进程内用 asyncio 锁串行化“读取-修改-保存”，跨进程用文件锁
+CONFIG_LOCK_FILE = CONFIG_FILE + ".lock"
+_config_write_lock = asyncio.Lock()
+_config_save_lock = threading.Lock()
+CONFIG_CONFLICT_MESSAGE = "密码已被其他操作修改，请重试"
+
+def _lock_config_file():
+    """获取跨进程配置写锁并读取最新配置，返回 (锁文件, config)（阻塞，在线程池中调用）
+    
+    不支持 fcntl 的平台上只使用进程内锁，锁文件为None。
+    """
+    lock_file = None
+    if fcntl is not None:
+        lock_file = open(CONFIG_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        except:
+            lock_file.close()
+            raise
+    try:
+        return lock_file, load_config()
+    except:
+        _unlock_config_file(lock_file)
+        raise
+
+def _unlock_config_file(lock_file):
+    """释放跨进程配置写锁（不会阻塞）"""
+    if lock_file is None:
+        return
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+def _unlock_when_acquired(future):
+    """等待加锁时请求被取消：线程拿到锁后立即释放"""
+    if not future.cancelled() and future.exception() is None:
+        _unlock_config_file(future.result()[0])
+
+@contextlib.asynccontextmanager
+async def config_transaction():
+    """以加锁的“读取-修改-保存”方式修改配置
+    
+    用法: async with config_transaction() as config: config["enabled"] = False
+    代码块正常结束且配置有改动时保存；并发的修改依次执行，不会互相覆盖。
+    事件循环上只等待进程内的 _config_write_lock；文件锁、读取和 fsync 都在线程池中执行，
+    磁盘慢或其他进程持有锁时不会阻塞其他请求。
+    """
+    async with _config_write_lock:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, _lock_config_file)
+        try:
+            lock_file, config = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(_unlock_when_acquired)
+            raise
+        
+        try:
+            original = dict(config)
+            yield config
+            if config != original:
+                await loop.run_in_executor(None, save_config, config)
+        finally:
+            _unlock_config_file(lock_file)
+
 def save_config(config):
-    """保存配置（混淆存储）"""
+    """保存配置（混淆存储，同时更新内存缓存）
+    
+    先写入同目录下的临时文件并 fsync，再用 os.replace 原子替换，
+    任何时刻读取到的都是完整的旧配置或新配置。
+    """
     config["last_modified"] = time.strftime("%Y-%m-%d %H:%M:%S")
     
     data = json.dumps(config, indent=2)
     encoded = base64.b64encode(data.encode('utf-8')).decode('utf-8')
     
-    try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            f.write(encoded)
-    except Exception as e:
-        print(f"\033[91m[Workflow Protector] 保存配置失败: {e}\033[0m")
-        raise e
+    # 写盘使用单独的锁，读取缓存的 _config_lock 只在最后更新缓存时持有，不会等待 fsync
+    with _config_save_lock:
+        fd, tmp_path = tempfile.mkstemp(prefix=".wp_config.", suffix=".tmp", dir=CONFIG_DIR)
+        try:
+            # mkstemp 创建的文件权限即为 600
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(encoded)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, CONFIG_FILE)
+        except Exception as e:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            print(f"\033[91m[Workflow Protector] 保存配置失败: {e}\033[0m")
+            raise e
+        
+        # 同步目录项，保证断电后重命名不会丢失
+        try:
+            dir_fd = os.open(CONFIG_DIR, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+        
+        # 写入后立即刷新缓存，避免下一次读取再走磁盘
+        with _config_lock:
+            _config_cache["config"] = dict(config)
+            _config_cache["signature"] = _config_signature()
     
+    notify_status_changed()
+
+# 等待状态变化的长轮询请求（asyncio.Future），本进程保存配置时唤醒
+_status_waiters = set()
+_status_waiters_lock = threading.Lock()
+
+def notify_status_changed():
+    """唤醒所有等待状态变化的长轮询请求（可在任意线程调用）"""
+    with _status_waiters_lock:
+        waiters = list(_status_waiters)
+    for waiter in waiters:
+        try:
+            waiter.get_loop().call_soon_threadsafe(_wake_status_waiter, waiter)
+        except RuntimeError:
+            with _status_waiters_lock:
+                _status_waiters.discard(waiter)
+
+def _wake_status_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(True)
+
+async def wait_status_change(timeout):
+    """等待下一次状态变化，超时返回False"""
+    waiter = asyncio.get_running_loop().create_future()
+    with _status_waiters_lock:
+        _status_waiters.add(waiter)
     try:
-        os.chmod(CONFIG_FILE, stat.S_IRUSR | stat.S_IWUSR)
-    except:
-        pass
+        done, _ = await asyncio.wait([waiter], timeout=timeout)
+        return bool(done)
+    finally:
+        with _status_waiters_lock:
+            _status_waiters.discard(waiter)
 
 def hash_password(password, salt=None):
     """使用PBKDF2进行密码哈希（更安全）"""
@@ -275,69 +1489,828 @@ def verify_password(password, stored_hash, stored_salt):
     # 使用常量时间比较，防止时序攻击
     return secrets.compare_digest(computed_hash, stored_hash)
 
+# ==================== 访问日志 ====================
+
+LOG_FILE = os.path.join(CONFIG_DIR, ".wp_access.log")  # 隐藏日志文件
+LOG_QUEUE_SIZE = 10000     # 内存中最多积压的日志行数
+LOG_FLUSH_INTERVAL = 1.0   # 定时写盘间隔（秒）
+LOG_FLUSH_BATCH = 256      # 积压达到该行数时提前写盘
+LOG_MAX_BYTES = int(os.environ.get("WP_LOG_MAX_BYTES", str(5 * 1024 * 1024)))  # 单个日志段最大字节数
+LOG_MAX_AGE = int(os.environ.get("WP_LOG_MAX_AGE", "86400"))                   # 单个日志段最长时间（秒）
+LOG_BACKUPS = int(os.environ.get("WP_LOG_BACKUPS", "10"))                      # 保留的历史日志段数量
+LOG_FORMAT = os.environ.get("WP_LOG_FORMAT", "json")   # json: 每行一条JSON记录 | text: 旧版文本格式
+LOG_INDEX_FILE = LOG_FILE + ".index"
+LOG_QUERY_MAX = 1000
+LOG_STATS_TOP = 20         # 聚合统计中按IP列出的最大条目数
+
+_LOG_LINE_RE = re.compile(
+    r"^\[(?P<ts>[^\]]+)\] \[(?P<status>[✓✗])\] (?P<action>.*?) \| IP: (?P<ip>.*?) \| (?P<details>.*)$"
+)
+
+def format_log_record(record):
+    """把日志记录格式化为文本行（旧版格式，用于界面显示）"""
+    status = "✓" if record["success"] else "✗"
+    return f"[{record['ts']}] [{status}] {record['action']} | IP: {record['ip']} | {record['details']}"
+
+def serialize_log_record(record):
+    """按 LOG_FORMAT 把日志记录序列化为一行（不含换行符）"""
+    if LOG_FORMAT == "text":
+        return format_log_record(record)
+    return json_dumps(record).decode('utf-8')
+
+def parse_log_line(line):
+    """解析一行日志（JSON记录或旧版文本），格式不符时返回None"""
+    if line.startswith("{"):
+        try:
+            record = json_loads(line)
+        except ValueError:
+            return None
+        if not isinstance(record, dict) or "ts" not in record:
+            return None
+        return {
+            "ts": record["ts"],
+            "success": bool(record.get("success")),
+            "action": record.get("action", ""),
+            "ip": record.get("ip", "unknown"),
+            "details": record.get("details", "")
+        }
+    
+    match = _LOG_LINE_RE.match(line)
+    if not match:
+        return None
+    return {
+        "ts": match.group("ts"),
+        "success": match.group("status") == "✓",
+        "action": match.group("action"),
+        "ip": match.group("ip"),
+        "details": match.group("details")
+    }
+
+def iter_lines_reverse(path, block_size=64 * 1024):
+    """从文件末尾向前逐行读取（最新的在前），读取最后N行的开销与文件大小无关"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b""
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size) + remainder
+            lines = block.split(b"\n")
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode('utf-8', errors='replace')
+        if remainder:
+            yield remainder.decode('utf-8', errors='replace')
+
+def _segment_lines_reverse(path):
+    """按最新在前的顺序读取一个日志段（历史段为gzip压缩）"""
+    if path.endswith(".gz"):
+        with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+        return (line for line in reversed(lines) if line)
+    return iter_lines_reverse(path)
+
+def new_log_summary():
+    """日志段摘要：时间范围、IP/操作计数、成功/失败数、按IP的失败数、每分钟的 [尝试数, 失败数]"""
+    return {"lines": 0, "first_ts": None, "last_ts": None,
+            "ips": {}, "actions": {}, "successes": 0, "failures": 0,
+            "failed_ips": {}, "minutes": {}}
+
+def add_to_log_summary(summary, record):
+    """把一条记录累加到摘要中（O(1)，用于增量维护当前日志段的统计）"""
+    summary["lines"] += 1
+    summary["first_ts"] = summary["first_ts"] or record["ts"]
+    summary["last_ts"] = record["ts"]
+    summary["ips"][record["ip"]] = summary["ips"].get(record["ip"], 0) + 1
+    summary["actions"][record["action"]] = summary["actions"].get(record["action"], 0) + 1
+    minute = summary["minutes"].setdefault(record["ts"][:16], [0, 0])
+    minute[0] += 1
+    if record["success"]:
+        summary["successes"] += 1
+    else:
+        summary["failures"] += 1
+        summary["failed_ips"][record["ip"]] = summary["failed_ips"].get(record["ip"], 0) + 1
+        minute[1] += 1
+
+def _summarize_segment(path):
+    """扫描日志段建立摘要（仅在没有增量摘要时使用，例如旧版遗留的日志文件）"""
+    summary = new_log_summary()
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            record = parse_log_line(line.rstrip("\n"))
+            if record is not None:
+                add_to_log_summary(summary, record)
+    return summary
+
+def load_log_index():
+    """读取历史日志段索引 {段文件名: 摘要}"""
+    try:
+        with open(LOG_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_log_index(index):
+    # 索引含客户端IP，临时文件由 mkstemp 以 600 权限创建
+    fd, tmp_path = tempfile.mkstemp(prefix=".wp_log_index.", suffix=".tmp", dir=os.path.dirname(LOG_INDEX_FILE))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, LOG_INDEX_FILE)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+def list_log_segments():
+    """历史日志段路径，最新的在前"""
+    directory = os.path.dirname(LOG_FILE)
+    prefix = os.path.basename(LOG_FILE) + "."
+    try:
+        names = [n for n in os.listdir(directory) if n.startswith(prefix) and n.endswith(".gz")]
+    except OSError:
+        return []
+    def order(name):
+        # 名称形如 <日志文件>.<YYYYmmdd-HHMMSS>[-N].gz，同一秒内切分的段带序号
+        parts = name[len(prefix):-len(".gz")].split("-")
+        seq = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
+        return parts[:2], seq
+    return [os.path.join(directory, n) for n in sorted(names, key=order, reverse=True)]
+
+def _segment_may_match(summary, filters):
+    """根据索引判断日志段中是否可能有匹配的记录"""
+    if summary is None:
+        return True
+    if filters.get("since") and summary["last_ts"] and summary["last_ts"] < filters["since"]:
+        return False
+    if filters.get("until") and summary["first_ts"] and summary["first_ts"] > filters["until"]:
+        return False
+    if filters.get("ip") and filters["ip"] not in summary["ips"]:
+        return False
+    if filters.get("action") and filters["action"] not in summary["actions"]:
+        return False
+    if filters.get("success") is True and not summary["successes"]:
+        return False
+    if filters.get("success") is False and not summary["failures"]:
+        return False
+    return True
+
+def _record_matches(record, filters):
+    if record is None:
+        return False
+    if filters.get("ip") and record["ip"] != filters["ip"]:
+        return False
+    if filters.get("action") and record["action"] != filters["action"]:
+        return False
+    if filters.get("success") is not None and record["success"] != filters["success"]:
+        return False
+    if filters.get("until") and record["ts"] > filters["until"]:
+        return False
+    return True
+
+def query_logs(limit=100, offset=0, **filters):
+    """按条件查询日志（从新到旧扫描），返回 (按时间正序排列的日志行, 是否还有更早的匹配)
+    
+    filters: ip, action, success (bool), since, until ("YYYY-MM-DD HH:MM:SS")
+    没有过滤条件时只读取当前日志段的末尾；历史段先用索引排除不可能匹配的段。
+    """
+    filters = {k: v for k, v in filters.items() if v is not None and v != ""}
+    since = filters.get("since")
+    index = load_log_index()
+    segments = [LOG_FILE] if os.path.exists(LOG_FILE) else []
+    segments += list_log_segments()
+    
+    matches = []
+    skipped = 0
+    for segment in segments:
+        if segment != LOG_FILE and not _segment_may_match(index.get(os.path.basename(segment)), filters):
+            continue
+        
+        for line in _segment_lines_reverse(segment):
+            if filters:
+                record = parse_log_line(line)
+                # 更早的记录都不会再满足时间条件
+                if since and record is not None and record["ts"] < since:
+                    return list(reversed(matches)), False
+                if not _record_matches(record, filters):
+                    continue
+            
+            if skipped < offset:
+                skipped += 1
+                continue
+            if len(matches) >= limit:
+                return list(reversed(matches)), True
+            matches.append(line)
+    
+    return list(reversed(matches)), False
+
+class AccessLogWriter:
+    """后台访问日志写入器
+    
+    请求路径上只把日志行放入内存队列，由后台线程按批量大小或时间间隔写入一个长期打开的
+    文件句柄。队列满时由调用方同步写出积压（背压），内存占用始终有界，且不会丢日志。
+    写入失败的一批保留到下次重试，最多保留一个队列容量，持续失败时才丢弃最旧的行。
+    切分（压缩、写索引）只在后台线程中进行，flush() 只追加写入。
+    """
+    
+    def __init__(self, path=LOG_FILE, max_queue=LOG_QUEUE_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, batch_size=LOG_FLUSH_BATCH,
+                 max_bytes=LOG_MAX_BYTES, max_age=LOG_MAX_AGE, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.rotations = 0
+        self._segment_started = None
+        self._segment_summary = None
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.written = 0
+        self.backpressure = 0
+        self.write_errors = 0
+        self.dropped = 0
+        self.max_retry = max_queue
+        self._retry = []
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._file_lock = threading.Lock()
+        self._rotate_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+    
+    def write(self, line, record=None):
+        """写入一行日志（非阻塞，队列满时同步写出积压）
+        
+        record 为该行对应的记录字典，用于更新段摘要；未提供时写入后再解析该行。
+        """
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((line, record))
+        except queue.Full:
+            self.backpressure += 1
+            self.flush()
+            self._queue.put((line, record))
+        
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+    
+    def flush(self):
+        """把队列中的日志（以及上次写入失败的行）全部写入文件"""
+        with self._file_lock:
+            lines, self._retry = self._retry, []  # [(line, record)]
+            while True:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not lines:
+                return
+            
+            try:
+                if self._file is None:
+                    self._open()
+                self._file.write("".join(line for line, _ in lines))
+                self._file.flush()
+                self.written += len(lines)
+                for line, record in lines:
+                    if record is None:
+                        record = parse_log_line(line.rstrip("\n"))
+                    if record is not None:
+                        add_to_log_summary(self._segment_summary, record)
+            except Exception as e:
+                self._close()
+                self.write_errors += 1
+                if len(lines) > self.max_retry:
+                    self.dropped += len(lines) - self.max_retry
+                    lines = lines[-self.max_retry:]
+                self._retry = lines
+                print(f"\033[91m[Workflow Protector] 写入访问日志失败，{len(lines)} 行将在下次重试: {e}\033[0m")
+    
+    def remove(self):
+        """清除日志文件及历史段（丢弃未写出的积压，关闭句柄后删除）"""
+        with self._rotate_lock, self._file_lock:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._retry = []
+            self._close()
+            self._segment_summary = None
+            for path in [self.path, LOG_INDEX_FILE] + list_log_segments():
+                if os.path.exists(path):
+                    os.remove(path)
+    
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._retry)
+    
+    def segment_summary(self):
+        """当前日志段的统计摘要（副本）"""
+        with self._file_lock:
+            if self._segment_summary is None:
+                self._segment_summary = _summarize_segment(self.path) if os.path.exists(self.path) else new_log_summary()
+            return json.loads(json.dumps(self._segment_summary))
+    
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "written": self.written,
+            "backpressure": self.backpressure,
+            "write_errors": self.write_errors,
+            "dropped": self.dropped,
+            "rotations": self.rotations
+        }
+    
+    def _should_rotate(self):
+        if self._file is None:
+            return False
+        if os.fstat(self._file.fileno()).st_size >= self.max_bytes:
+            return True
+        return self._segment_started is not None and time.time() - self._segment_started >= self.max_age
+    
+    def rotate_if_due(self):
+        """当前日志段超过大小或时间上限时切分（只由后台线程调用）"""
+        with self._rotate_lock:
+            try:
+                self._rotate()
+            except Exception as e:
+                print(f"\033[91m[Workflow Protector] 切分访问日志失败: {e}\033[0m")
+    
+    def _rotate(self):
+        """切分当前日志段：重命名、gzip压缩、写入索引并清理过旧的段（需持有 _rotate_lock）
+        
+        只有重命名在文件锁内完成，压缩和写索引期间 flush() 照常写入新的日志段。
+        """
+        with self._file_lock:
+            if not self._should_rotate():
+                return
+            self._close()
+            
+            # 同一秒内多次切分时追加递增序号，保证段名按时间有序
+            rotated = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+            same_second = [p for p in list_log_segments() if p.startswith(rotated)]
+            if same_second:
+                latest = same_second[0][len(rotated):-len(".gz")]
+                rotated = f"{rotated}-{int(latest[1:] or 0) + 1}"
+            os.replace(self.path, rotated)
+            
+            summary = self._segment_summary
+            self._segment_summary = None
+        
+        if summary is None:
+            summary = _summarize_segment(rotated)
+        # 先写临时文件（mkstemp 创建，权限即为 600），压缩完成前查询不会读到不完整的段
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(rotated) + ".", suffix=".gz.tmp",
+                                        dir=os.path.dirname(rotated))
+        try:
+            with open(rotated, 'rb') as src, os.fdopen(fd, 'wb') as raw, \
+                    gzip.GzipFile(os.path.basename(rotated), 'wb', fileobj=raw) as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, rotated + ".gz")
+        except:
+            os.unlink(tmp_path)
+            raise
+        os.remove(rotated)
+        
+        index = load_log_index()
+        index[os.path.basename(rotated) + ".gz"] = summary
+        for old in list_log_segments()[self.backups:]:
+            index.pop(os.path.basename(old), None)
+            os.remove(old)
+        _save_log_index(index)
+        self.rotations += 1
+    
+    def _open(self):
+        # 新建的日志文件直接以 600 权限创建
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, 'a', encoding='utf-8')
+        self._segment_started = time.time()
+        if self._segment_summary is None:
+            self._segment_summary = _summarize_segment(self.path)
+        if self._file.tell() > 0:
+            # 继续写入已有的日志段时，以段内第一条记录的时间为起点
+            with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+                record = parse_log_line(f.readline().rstrip("\n"))
+            if record is not None:
+                try:
+                    self._segment_started = time.mktime(time.strptime(record["ts"], "%Y-%m-%d %H:%M:%S"))
+                except ValueError:
+                    pass
+        # 已有的日志文件也收紧为 600（只在打开时设置一次）
+        try:
+            os.chmod(self.path, stat.S_IRUSR | stat.S_IWUSR)  # 600
+        except:
+            pass
+    
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except:
+                pass
+            self._file = None
+    
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="wp-access-log", daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            self.rotate_if_due()
+
+_log_writer = AccessLogWriter()
+atexit.register(_log_writer.flush)
+
 def log_attempt(action, success, ip="unknown", details=""):
     """记录访问尝试"""
     config = load_config()
     if not config.get("log_attempts", True):
         return
     
-    log_file = os.path.join(CONFIG_DIR, ".wp_access.log")  # 隐藏日志文件
-    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    status = "✓" if success else "✗"
+    record = {
+        "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "success": bool(success),
+        "action": action,
+        "ip": ip,
+        "details": details
+    }
+    _log_writer.write(serialize_log_record(record) + "\n", record)
+
+def get_log_stats():
+    """获取日志写入器统计"""
+    return _log_writer.stats()
+
+def aggregate_logs(since=None, minutes=60):
+    """汇总访问日志：按IP的失败数、按操作的尝试数、最近若干分钟的每分钟速率
+    
+    只合并历史段索引与当前段的增量摘要，不读取原始日志行。
+    since 用于排除整段早于该时间的历史段（粒度为日志段）。
+    """
+    summaries = [_log_writer.segment_summary()]
+    for name, summary in load_log_index().items():
+        if since and summary.get("last_ts") and summary["last_ts"] < since:
+            continue
+        summaries.append(summary)
     
-    try:
-        with open(log_file, 'a', encoding='utf-8') as f:
-            f.write(f"[{timestamp}] [{status}] {action} | IP: {ip} | {details}\n")
+    total = new_log_summary()
+    for summary in summaries:
+        total["lines"] += summary.get("lines", 0)
+        total["successes"] += summary.get("successes", 0)
+        total["failures"] += summary.get("failures", 0)
+        for key in ("ips", "actions", "failed_ips"):
+            for name, count in summary.get(key, {}).items():
+                total[key][name] = total[key].get(name, 0) + count
+        for minute, (attempts, failures) in summary.get("minutes", {}).items():
+            bucket = total["minutes"].setdefault(minute, [0, 0])
+            bucket[0] += attempts
+            bucket[1] += failures
+    
+    now = time.time()
+    per_minute = []
+    for i in range(minutes - 1, -1, -1):
+        minute = time.strftime("%Y-%m-%d %H:%M", time.localtime(now - i * 60))
+        attempts, failures = total["minutes"].get(minute, (0, 0))
+        per_minute.append({"minute": minute, "attempts": attempts, "failures": failures})
+    
+    failures_by_ip = sorted(total["failed_ips"].items(), key=lambda item: item[1], reverse=True)
+    return {
+        "total": total["lines"],
+        "successes": total["successes"],
+        "failures": total["failures"],
+        "failures_by_ip": [{"ip": ip, "failures": count} for ip, count in failures_by_ip[:LOG_STATS_TOP]],
+        "attempts_by_action": total["actions"],
+        "per_minute": per_minute
+    }
+
+# ==================== 会话管理 ====================
+
+class SessionBackend(abc.ABC):
+    """会话后端接口
+    
+    会话以 {"expires", "ip", "created"} 字典表示。默认使用进程内存储；
+    多个ComfyUI进程需要共享授权时可切换为SQLite等共享后端。
+    blocking 为True的后端（会访问磁盘或网络）在事件循环上通过 session_call() 放到线程池调用。
+    """
+    
+    blocking = False
+    
+    @abc.abstractmethod
+    def create(self, ip="unknown"):
+        """创建会话并返回token"""
+    
+    @abc.abstractmethod
+    def get(self, token):
+        """获取未过期的会话，不存在或已过期时返回None"""
+    
+    @abc.abstractmethod
+    def touch(self, token):
+        """刷新会话有效期"""
+    
+    @abc.abstractmethod
+    def pop(self, token, default=None):
+        """删除会话并返回它"""
+    
+    @abc.abstractmethod
+    def purge(self, now=None):
+        """清理已过期会话，返回清理数量"""
+    
+    @abc.abstractmethod
+    def clear(self):
+        """删除所有会话"""
+    
+    @abc.abstractmethod
+    def stats(self):
+        """会话统计：live / created / expired"""
+    
+    def __contains__(self, token):
+        return self.get(token) is not None
+    
+    def __len__(self):
+        return self.stats()["live"]
+
+class MemorySessionBackend(SessionBackend):
+    """进程内会话存储：字典 + 按过期时间排序的小顶堆
+    
+    查找与刷新都是 O(1)：刷新只改写字典中的过期时间，不动堆。堆顶条目弹出时
+    再与字典核对，会话已被刷新则按新的过期时间重新入堆，已删除则直接丢弃。
+    清理按 SESSION_PURGE_INTERVAL 节流，在正常读写时顺带完成。
+    """
+    
+    def __init__(self):
+        self._sessions = {}  # {token: {"expires": timestamp, "ip": ip, "created": timestamp}}
+        self._heap = []      # [(expires, token)]
+        self._lock = threading.Lock()
+        self._next_purge = 0
+        self.created_total = 0
+        self.expired_total = 0
+    
+    def create(self, ip="unknown"):
+        """创建会话并返回token"""
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        expires = now + SESSION_DURATION
+        with self._lock:
+            self._sessions[token] = {"expires": expires, "ip": ip, "created": now}
+            heapq.heappush(self._heap, (expires, token))
+            self.created_total += 1
+        self._maybe_purge(now)
+        return token
+    
+    def get(self, token):
+        """获取未过期的会话，已过期的会话会被立即移除"""
+        now = time.time()
+        self._maybe_purge(now)
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return None
+            if now > session["expires"]:
+                del self._sessions[token]
+                self.expired_total += 1
+                return None
+            return session
+    
+    def touch(self, token):
+        """刷新会话有效期"""
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is not None:
+                session["expires"] = time.time() + SESSION_DURATION
+    
+    def purge(self, now=None):
+        """清理所有已过期会话，返回清理数量"""
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, token = heapq.heappop(self._heap)
+                session = self._sessions.get(token)
+                if session is None:
+                    continue
+                if session["expires"] > now:
+                    heapq.heappush(self._heap, (session["expires"], token))
+                    continue
+                del self._sessions[token]
+                removed += 1
+            self.expired_total += removed
+            self._next_purge = now + SESSION_PURGE_INTERVAL
+        return removed
+    
+    def _maybe_purge(self, now):
+        if now >= self._next_purge:
+            self.purge(now)
+    
+    def pop(self, token, default=None):
+        with self._lock:
+            return self._sessions.pop(token, default)
+    
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._heap.clear()
+    
+    def stats(self):
+        """会话统计：存活、累计创建、累计过期"""
+        with self._lock:
+            return {
+                "live": len(self._sessions),
+                "created": self.created_total,
+                "expired": self.expired_total
+            }
+    
+    def __len__(self):
+        return len(self._sessions)
+
+class SQLiteSessionBackend(SessionBackend):
+    """基于SQLite文件的共享会话存储，同一台机器上的多个ComfyUI进程共用授权
+    
+    最近验证过的会话在本进程内缓存 SESSION_CACHE_TTL 秒，热路径上的重复验证不访问数据库；
+    其他进程的登出/清空最迟在缓存过期后生效。在线会话数同样缓存 SESSION_CACHE_TTL 秒。
+    """
+    
+    blocking = True
+    
+    def __init__(self, path=SESSION_DB_FILE, cache_ttl=SESSION_CACHE_TTL, cache_size=1024):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.created_total = 0
+        self.expired_total = 0
+        self._cache = OrderedDict()  # {token: (session, cached_at)}
+        self._lock = threading.Lock()
+        self._next_purge = 0
+        self._live_count = None  # (live, counted_at)
         
-        # 设置文件权限
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "token TEXT PRIMARY KEY, ip TEXT, created REAL, expires REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
         try:
-            os.chmod(log_file, stat.S_IRUSR | stat.S_IWUSR)  # 600
+            os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
         except:
             pass
-    except:
-        pass
+    
+    def _cache_put(self, token, session, now):
+        self._cache[token] = (session, now)
+        self._cache.move_to_end(token)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    def create(self, ip="unknown"):
+        token = secrets.token_urlsafe(32)
+        now = time.time()
+        session = {"expires": now + SESSION_DURATION, "ip": ip, "created": now}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (token, ip, created, expires) VALUES (?, ?, ?, ?)",
+                (token, ip, now, session["expires"])
+            )
+            self._cache_put(token, session, now)
+            self.created_total += 1
+        self._maybe_purge(now)
+        return token
+    
+    def get(self, token):
+        now = time.time()
+        self._maybe_purge(now)
+        with self._lock:
+            cached = self._cache.get(token)
+            if cached is not None and now - cached[1] < self.cache_ttl and now <= cached[0]["expires"]:
+                return cached[0]
+            
+            row = self._conn.execute(
+                "SELECT ip, created, expires FROM sessions WHERE token = ?", (token,)
+            ).fetchone()
+            if row is None:
+                self._cache.pop(token, None)
+                return None
+            
+            session = {"ip": row[0], "created": row[1], "expires": row[2]}
+            if now > session["expires"]:
+                self._conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+                self._cache.pop(token, None)
+                self.expired_total += 1
+                return None
+            
+            self._cache_put(token, session, now)
+            return session
+    
+    def touch(self, token):
+        now = time.time()
+        expires = now + SESSION_DURATION
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET expires = ? WHERE token = ?", (expires, token))
+            cached = self._cache.get(token)
+            if cached is not None:
+                cached[0]["expires"] = expires
+    
+    def pop(self, token, default=None):
+        session = self.get(token)
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE token = ?", (token,))
+            self._cache.pop(token, None)
+        return session if session is not None else default
+    
+    def purge(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,)).rowcount
+            self.expired_total += removed
+            self._next_purge = now + SESSION_PURGE_INTERVAL
+        return removed
+    
+    def _maybe_purge(self, now):
+        if now >= self._next_purge:
+            self.purge(now)
+    
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions")
+            self._cache.clear()
+    
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            if self._live_count is None or now - self._live_count[1] >= self.cache_ttl:
+                live = self._conn.execute(
+                    "SELECT COUNT(*) FROM sessions WHERE expires > ?", (now,)
+                ).fetchone()[0]
+                self._live_count = (live, now)
+            return {
+                "live": self._live_count[0],
+                "created": self.created_total,
+                "expired": self.expired_total
+            }
 
-# ==================== 会话管理 ====================
+# 可用的会话后端，第三方可通过 SESSION_BACKENDS[name] = factory 注册
+SESSION_BACKENDS = {
+    "memory": MemorySessionBackend,
+    "sqlite": SQLiteSessionBackend,
+}
+
+def create_session_backend(name=SESSION_BACKEND):
+    """按名称创建会话后端，失败时回退到内存后端"""
+    try:
+        return SESSION_BACKENDS[name]()
+    except Exception as e:
+        print(f"\033[91m[Workflow Protector] 会话后端 {name} 初始化失败，使用内存存储: {e}\033[0m")
+        return MemorySessionBackend()
+
+active_sessions = create_session_backend()
 
 def create_session(ip="unknown"):
     """创建新会话"""
-    token = secrets.token_urlsafe(32)
-    active_sessions[token] = {
-        "expires": time.time() + SESSION_DURATION,
-        "ip": ip,
-        "created": time.time()
-    }
-    cleanup_sessions()
-    return token
+    return active_sessions.create(ip)
 
-def verify_session(token, ip="unknown"):
+def verify_session(token, ip="unknown", config=None):
     """验证会话"""
-    if not token or token not in active_sessions:
+    if not token:
         return False
     
-    session = active_sessions[token]
-    
-    # 检查是否过期
-    if time.time() > session["expires"]:
-        del active_sessions[token]
+    # 已过期的会话在 get() 中被移除
+    session = active_sessions.get(token)
+    if session is None:
         return False
     
     # 严格模式下检查IP
-    config = load_config()
+    if config is None:
+        config = load_config()
     if config.get("protection_level") == "strict":
         if session["ip"] != ip and session["ip"] != "unknown":
             return False
     
-    # 刷新会话
-    session["expires"] = time.time() + SESSION_DURATION
+    # 刷新会话：距上次刷新不足 SESSION_TOUCH_INTERVAL 秒时跳过，避免连续请求反复写入
+    if session["expires"] - time.time() < SESSION_DURATION - SESSION_TOUCH_INTERVAL:
+        active_sessions.touch(token)
     return True
 
 def cleanup_sessions():
     """清理过期会话"""
-    current_time = time.time()
-    expired = [t for t, s in active_sessions.items() if current_time > s["expires"]]
-    for token in expired:
-        del active_sessions[token]
+    return active_sessions.purge()
+
+def get_session_stats():
+    """获取会话统计"""
+    return active_sessions.stats()
+
+async def session_call(func, *args):
+    """在事件循环上调用会话后端：会阻塞的后端（SQLite）放到线程池，内存后端直接调用"""
+    if active_sessions.blocking:
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+    return func(*args)
 
 def get_client_ip(request):
     """获取客户端IP"""
@@ -349,26 +2322,44 @@ def get_client_ip(request):
 
 # ==================== 保护检查 ====================
 
-def is_protection_active():
+def is_protection_active(config=None):
     """检查保护是否激活"""
-    config = load_config()
+    if config is None:
+        config = load_config()
     return config.get("password_hash") is not None and config.get("enabled", True)
 
-def check_authorization(request):
-    """检查请求是否已授权"""
-    if not is_protection_active():
+_AUTH_REQUEST_KEY = "workflow_protector_authorized"
+
+async def check_authorization(request, config=None):
+    """检查请求是否已授权（调用方已读取配置时可直接传入，避免重复读取）
+    
+    结果缓存在 request 上，同一请求内多次调用只验证一次。
+    """
+    authorized = request.get(_AUTH_REQUEST_KEY)
+    if authorized is None:
+        authorized = await _check_authorization(request, config)
+        request[_AUTH_REQUEST_KEY] = authorized
+    return authorized
+
+async def _check_authorization(request, config=None):
+    if config is None:
+        config = load_config()
+    if not is_protection_active(config):
         return True
     
-    # 从多个来源获取token
-    token = (
+    token = get_session_token(request)
+    ip = get_client_ip(request)
+    
+    return await session_call(verify_session, token, ip, config)
+
+def get_session_token(request):
+    """从多个来源获取会话token"""
+    return (
         request.headers.get('X-WP-Token') or 
         request.headers.get('Authorization', '').replace('Bearer ', '') or
         request.cookies.get('wp_session') or
         request.query.get('wp_token')
     )
-    ip = get_client_ip(request)
-    
-    return verify_session(token, ip)
 
 def check_password(password):
     """检查密码是否正确"""
@@ -381,101 +2372,492 @@ def check_password(password):
     
     return verify_password(password, stored_hash, stored_salt)
 
+# ==================== 运行指标 ====================
+
+# 延迟直方图的桶上限（秒），覆盖从缓存命中到完整PBKDF2的范围
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 设置后 /workflow_protector/metrics 接受 "Authorization: Bearer <令牌>"，便于 Prometheus 抓取
+METRICS_TOKEN = os.environ.get("WP_METRICS_TOKEN", "")
+
+class Metrics:
+    """进程内指标：计数器与延迟直方图，按 Prometheus 文本格式导出
+    
+    记录一次只是在锁内做一次字典累加（直方图再加一次二分查找），开销可以忽略。
+    """
+    
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}     # {(名称, 标签): 值}
+        self._histograms = {}   # {(名称, 标签): [各桶计数..., +Inf计数, 总和]}
+        self._help = {}
+        self._lock = threading.Lock()
+    
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+    
+    def render(self, gauges=()):
+        """导出为 Prometheus 文本格式，gauges 为采集时读取的 (名称, 类型, 说明, 值, 标签)"""
+        families = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                families.setdefault(name, []).append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                samples = families.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), histogram[:-1]):
+                    cumulative += count
+                    samples.append((name + "_bucket", labels + (("le", str(bound)),), cumulative))
+                samples.append((name + "_sum", labels, round(histogram[-1], 6)))
+                samples.append((name + "_count", labels, cumulative))
+        
+        for name, kind, text, value, labels in gauges:
+            self._help.setdefault(name, (kind, text))
+            families.setdefault(name, []).append((name, tuple(sorted(labels.items())), value))
+        
+        lines = []
+        for family in sorted(families):
+            kind, text = self._help.get(family, ("untyped", ""))
+            lines.append(f"# HELP {family} {text}")
+            lines.append(f"# TYPE {family} {kind}")
+            for name, labels, value in families[family]:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+_metrics = Metrics()
+_metrics.describe("wp_requests_total", "counter", "Plugin API requests by endpoint and HTTP status")
+_metrics.describe("wp_request_duration_seconds", "histogram", "Plugin API request latency")
+_metrics.describe("wp_kdf_duration_seconds", "histogram", "Time spent in the key-derivation pool per job")
+_metrics.describe("wp_blocked_requests_total", "counter", "Requests blocked by route protection, by protection level")
+
+def instrumented(endpoint):
+    """路由处理器装饰器：记录请求数（按状态码）和延迟"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                return response
+            finally:
+                _metrics.inc("wp_requests_total", endpoint=endpoint, status=status)
+                _metrics.observe("wp_request_duration_seconds", time.perf_counter() - start, endpoint=endpoint)
+        return wrapper
+    return decorator
+
+def collect_metrics():
+    """读取各组件现有的统计，生成 Prometheus 文本"""
+    config_stats = get_config_cache_stats()
+    kdf_stats = get_kdf_stats()
+    session_stats = active_sessions.stats()
+    log_stats = get_log_stats()
+    limiter_stats = get_limiter_stats()
+    key_cache_stats = _derived_key_cache.stats()
+    store_stats = _workflow_store.stats()
+    store_cache_stats = _decrypted_cache.stats()
+    
+    gauges = [
+        ("wp_config_reloads_total", "counter", "Config file reads (cache misses)", config_stats["misses"], {}),
+        ("wp_config_cache_hits_total", "counter", "Config reads served from memory", config_stats["hits"], {}),
+        ("wp_kdf_pending", "gauge", "Jobs waiting in the key-derivation pool", kdf_stats["pending"], {}),
+        ("wp_kdf_running", "gauge", "Jobs running in the key-derivation pool", kdf_stats["running"], {}),
+        ("wp_kdf_rejected_total", "counter", "Jobs rejected because the KDF queue was full", kdf_stats["rejected"], {}),
+        ("wp_sessions_live", "gauge", "Live sessions", session_stats["live"], {}),
+        ("wp_sessions_created_total", "counter", "Sessions created", session_stats["created"], {}),
+        ("wp_sessions_expired_total", "counter", "Sessions expired", session_stats["expired"], {}),
+        ("wp_log_queue_depth", "gauge", "Access-log lines waiting to be written", log_stats["queue_depth"], {}),
+        ("wp_log_lines_written_total", "counter", "Access-log lines written", log_stats["written"], {}),
+        ("wp_log_backpressure_total", "counter", "Log writes that had to flush synchronously", log_stats["backpressure"], {}),
+        ("wp_log_rotations_total", "counter", "Access-log rotations", log_stats["rotations"], {}),
+        ("wp_log_write_errors_total", "counter", "Failed access-log writes (lines kept for retry)", log_stats["write_errors"], {}),
+        ("wp_log_dropped_total", "counter", "Access-log lines dropped after repeated write failures", log_stats["dropped"], {}),
+        ("wp_key_cache_entries", "gauge", "Cached derived decryption keys", key_cache_stats["entries"], {}),
+        ("wp_key_cache_hits_total", "counter", "Derived key cache hits", key_cache_stats["hits"], {}),
+        ("wp_key_cache_misses_total", "counter", "Derived key cache misses", key_cache_stats["misses"], {}),
+        ("wp_limiter_tracked_ips", "gauge", "IPs tracked by the brute-force limiter", limiter_stats["tracked_ips"], {}),
+        ("wp_store_objects", "gauge", "Encrypted workflows in the store", store_stats["objects"], {}),
+        ("wp_store_bytes", "gauge", "Bytes used by the workflow store", store_stats["bytes"], {}),
+        ("wp_store_cache_bytes", "gauge", "Decrypted workflow bytes cached for sessions", store_cache_stats["bytes"], {}),
+        ("wp_store_cache_hits_total", "counter", "Stored workflow decrypts served from the session cache", store_cache_stats["hits"], {}),
+        ("wp_store_cache_misses_total", "counter", "Stored workflow decrypts that missed the session cache", store_cache_stats["misses"], {}),
+    ]
+    for reason in ("ip", "backoff", "global"):
+        gauges.append(("wp_limiter_blocked_total", "counter", "Password attempts rejected by the limiter",
+                       limiter_stats[f"blocked_{reason}"], {"reason": reason}))
+    return _metrics.render(gauges)
+
+# ==================== 密钥派生线程池 ====================
+
+# PBKDF2 每次需要10万次迭代，放到独立线程池中执行，避免阻塞事件循环
+KDF_MAX_WORKERS = max(1, int(os.environ.get("WP_KDF_WORKERS", "2")))
+KDF_MAX_PENDING = max(1, int(os.environ.get("WP_KDF_MAX_PENDING", "32")))
+
+class KDFBusyError(Exception):
+    """密钥派生队列已满"""
+    pass
+
+_kdf_executor = None
+_kdf_lock = threading.Lock()
+_kdf_stats = {
+    "pending": 0,
+    "running": 0,
+    "completed": 0,
+    "rejected": 0,
+    "max_pending": 0,
+    "total_seconds": 0.0
+}
+
+def _get_kdf_executor():
+    """获取（按需创建）密钥派生线程池"""
+    global _kdf_executor
+    with _kdf_lock:
+        if _kdf_executor is None:
+            _kdf_executor = ThreadPoolExecutor(
+                max_workers=KDF_MAX_WORKERS,
+                thread_name_prefix="wp-kdf"
+            )
+        return _kdf_executor
+
+async def run_in_kdf_pool(func, *args, **kwargs):
+    """在密钥派生线程池中执行耗时的哈希/加解密操作
+    
+    排队任务超过 KDF_MAX_PENDING 时抛出 KDFBusyError，而不是无限堆积。
+    """
+    state = {"started": False, "cancelled": False}
+    
+    with _kdf_lock:
+        if _kdf_stats["pending"] >= KDF_MAX_PENDING:
+            _kdf_stats["rejected"] += 1
+            raise KDFBusyError("服务器繁忙，请稍后重试")
+        _kdf_stats["pending"] += 1
+        _kdf_stats["max_pending"] = max(_kdf_stats["max_pending"], _kdf_stats["pending"])
+    
+    def task():
+        with _kdf_lock:
+            if state["cancelled"]:
+                return None
+            state["started"] = True
+            _kdf_stats["pending"] -= 1
+            _kdf_stats["running"] += 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with _kdf_lock:
+                _kdf_stats["running"] -= 1
+                _kdf_stats["completed"] += 1
+                _kdf_stats["total_seconds"] += elapsed
+            _metrics.observe("wp_kdf_duration_seconds", elapsed)
+    
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_kdf_executor(), task)
+    finally:
+        # 请求在任务开始前被取消时，任务不会再执行，需要手动归还排队计数
+        with _kdf_lock:
+            if not state["started"] and not state["cancelled"]:
+                state["cancelled"] = True
+                _kdf_stats["pending"] -= 1
+
+def get_kdf_stats():
+    """获取密钥派生线程池统计（队列深度等）"""
+    with _kdf_lock:
+        stats = dict(_kdf_stats)
+    stats["workers"] = KDF_MAX_WORKERS
+    stats["max_queue"] = KDF_MAX_PENDING
+    return stats
+
+# ==================== 暴力破解限流 ====================
+
+# 每个IP一个令牌桶：允许短时间内连续尝试 LIMIT_BURST 次，之后按 LIMIT_RATE 次/秒恢复
+LIMIT_BURST = float(os.environ.get("WP_LIMIT_BURST", "5"))
+LIMIT_RATE = float(os.environ.get("WP_LIMIT_RATE", str(1 / 12)))
+# 全局令牌桶：限制所有IP合计的尝试速率，防止分布式尝试耗尽CPU
+LIMIT_GLOBAL_BURST = float(os.environ.get("WP_LIMIT_GLOBAL_BURST", "30"))
+LIMIT_GLOBAL_RATE = float(os.environ.get("WP_LIMIT_GLOBAL_RATE", "5"))
+# 连续失败超过 LIMIT_FREE_FAILURES 次后指数退避：2、4、8…秒，最长 LIMIT_BACKOFF_MAX
+LIMIT_FREE_FAILURES = int(os.environ.get("WP_LIMIT_FREE_FAILURES", "3"))
+LIMIT_BACKOFF_BASE = 2.0
+LIMIT_BACKOFF_MAX = 900.0
+LIMIT_MAX_IPS = 10000      # 最多跟踪的IP数，超出时淘汰最久未活动的
+
+class BruteForceLimiter:
+    """密码尝试限流器
+    
+    在运行密钥派生之前调用 acquire()，超限时直接拒绝（429），不占用连接也不消耗CPU。
+    acquire() 先预扣令牌，限制同时进行的尝试；密码正确或尝试与密码无关时由 record() / release()
+    退还，只有密码错误真正消耗令牌，正常使用不会被限流。
+    每个IP只保存 [令牌数, 上次更新时间, 连续失败数, 封禁截止时间]，按LRU淘汰。
+    """
+    
+    def __init__(self, burst=LIMIT_BURST, rate=LIMIT_RATE,
+                 global_burst=LIMIT_GLOBAL_BURST, global_rate=LIMIT_GLOBAL_RATE,
+                 free_failures=LIMIT_FREE_FAILURES, max_ips=LIMIT_MAX_IPS):
+        self.burst = burst
+        self.rate = rate
+        self.global_burst = global_burst
+        self.global_rate = global_rate
+        self.free_failures = free_failures
+        self.max_ips = max_ips
+        self._clients = OrderedDict()
+        self._global = [global_burst, time.monotonic()]
+        self._lock = threading.Lock()
+        self._stats = {"allowed": 0, "blocked_ip": 0, "blocked_backoff": 0, "blocked_global": 0, "evicted": 0}
+    
+    @staticmethod
+    def _refill(bucket, burst, rate, now):
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    
+    def _client(self, ip, now):
+        client = self._clients.get(ip)
+        if client is None:
+            client = [self.burst, now, 0, 0.0]
+            self._clients[ip] = client
+            if len(self._clients) > self.max_ips:
+                self._clients.popitem(last=False)
+                self._stats["evicted"] += 1
+        else:
+            self._clients.move_to_end(ip)
+        return client
+    
+    def acquire(self, ip):
+        """登记一次尝试，允许时返回0，否则返回建议的重试等待秒数"""
+        now = time.monotonic()
+        with self._lock:
+            client = self._client(ip, now)
+            
+            if client[3] > now:
+                self._stats["blocked_backoff"] += 1
+                return client[3] - now
+            
+            self._refill(client, self.burst, self.rate, now)
+            if client[0] < 1:
+                self._stats["blocked_ip"] += 1
+                return (1 - client[0]) / self.rate
+            
+            self._refill(self._global, self.global_burst, self.global_rate, now)
+            if self._global[0] < 1:
+                self._stats["blocked_global"] += 1
+                return (1 - self._global[0]) / self.global_rate
+            
+            client[0] -= 1
+            self._global[0] -= 1
+            self._stats["allowed"] += 1
+            return 0
+    
+    def _refund(self, client, now):
+        self._refill(client, self.burst, self.rate, now)
+        client[0] = min(self.burst, client[0] + 1)
+        self._refill(self._global, self.global_burst, self.global_rate, now)
+        self._global[0] = min(self.global_burst, self._global[0] + 1)
+    
+    def release(self, ip):
+        """尝试没有检验密码（文件无效、队列已满等）：退还令牌，不计入失败"""
+        now = time.monotonic()
+        with self._lock:
+            self._refund(self._client(ip, now), now)
+    
+    def record(self, ip, success):
+        """记录尝试结果：成功退还令牌并清零连续失败数，失败过多时进入指数退避"""
+        now = time.monotonic()
+        with self._lock:
+            client = self._client(ip, now)
+            if success:
+                self._refund(client, now)
+                client[2] = 0
+                client[3] = 0.0
+                return
+            client[2] += 1
+            excess = client[2] - self.free_failures
+            if excess > 0:
+                client[3] = now + min(LIMIT_BACKOFF_BASE ** excess, LIMIT_BACKOFF_MAX)
+    
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+    
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["tracked_ips"] = len(self._clients)
+            stats["backoff_ips"] = sum(1 for client in self._clients.values() if client[3] > now)
+        stats["blocked"] = stats["blocked_ip"] + stats["blocked_backoff"] + stats["blocked_global"]
+        return stats
+
+_brute_force_limiter = BruteForceLimiter()
+
+def throttle_response(ip, action):
+    """超出尝试限制时返回429响应，否则返回None"""
+    retry_after = _brute_force_limiter.acquire(ip)
+    if not retry_after:
+        return None
+    
+    retry_after = max(1, int(retry_after + 0.999))
+    log_attempt(action, False, ip, f"Throttled, retry after {retry_after}s")
+    return json_response(
+        {"success": False, "message": f"尝试次数过多，请在{retry_after}秒后重试", "retry_after": retry_after},
+        status=429,
+        headers={"Retry-After": str(retry_after)}
+    )
+
+def is_password_failure(error):
+    """解密错误是否由密码错误引起（文件无效、格式不支持等不算）"""
+    return bool(error) and error.startswith("解密失败: 密码错误")
+
+def record_decrypt_result(ip, error):
+    """按解密结果登记尝试：成功、密码错误、与密码无关的错误分别处理"""
+    if not error:
+        _brute_force_limiter.record(ip, True)
+    elif is_password_failure(error):
+        _brute_force_limiter.record(ip, False)
+    else:
+        _brute_force_limiter.release(ip)
+
+async def run_password_check(ip, func, *args, **kwargs):
+    """在KDF线程池中校验密码；未能完成（队列已满等）时退还 acquire() 预扣的令牌"""
+    try:
+        return await run_in_kdf_pool(func, *args, **kwargs)
+    except KDFBusyError:
+        _brute_force_limiter.release(ip)
+        raise
+
+def get_limiter_stats():
+    """获取限流器统计（被拒绝的尝试次数等）"""
+    return _brute_force_limiter.stats()
+
 # ==================== API保护中间件 ====================
 
-# 保存原始路由处理器
-_original_handlers = {}
+# 服务端路由保护默认关闭：/verify 成功后前端请求会带上 httponly 的 wp_session cookie，
+# 但尚未验证的页面没有会话，开启后在验证前无法加载节点信息/队列，适合配合反向代理或纯API使用的场景
+ROUTE_ENFORCEMENT = os.environ.get("WP_ENFORCE_ROUTES", "0").lower() in ("1", "true", "yes")
+
+# 敏感路径（同时匹配 ComfyUI 的 /api 前缀路由），启动时预编译为一个正则
+SENSITIVE_PATHS = (
+    '/prompt',      # 工作流执行
+    '/queue',       # 队列
+    '/history',     # 历史记录
+    '/object_info', # 节点信息
+    '/view',        # 查看输出
+)
+_SENSITIVE_PATH_RE = re.compile(
+    r"^(?:/api)?(?:" + "|".join(re.escape(p) for p in SENSITIVE_PATHS) + ")"
+)
+# 插件自身的接口（验证、状态等）自行处理授权，不经过路由保护
+_EXEMPT_PATH_RE = re.compile(r"^(?:/api)?/workflow_protector/")
+
+async def protection_response(request, path=None):
+    """按保护级别检查请求，需要拦截时返回401响应，否则返回None
+    
+    每个请求只读取一次配置，且只在确实需要时才验证会话。
+    """
+    path = path or request.path
+    if _EXEMPT_PATH_RE.match(path):
+        return None
+    
+    is_sensitive = _SENSITIVE_PATH_RE.match(path) is not None
+    method = request.method
+    if not is_sensitive and method != 'POST':
+        return None
+    
+    config = load_config()
+    if not is_protection_active(config):
+        return None
+    
+    protection_level = config.get("protection_level", "strict")
+    
+    # 严格模式
+    if protection_level == "strict":
+        if not await check_authorization(request, config):
+            _metrics.inc("wp_blocked_requests_total", level="strict")
+            log_attempt(f"{method} {path}", False, get_client_ip(request), "Strict mode blocked")
+            return json_response({
+                "error": "需要授权才能执行此操作",
+                "code": "AUTH_REQUIRED",
+                "message": "请先通过工作流保护验证"
+            }, status=401)
+    
+    # 中等模式
+    elif protection_level == "moderate":
+        if is_sensitive and not await check_authorization(request, config):
+            _metrics.inc("wp_blocked_requests_total", level="moderate")
+            log_attempt(f"{method} {path}", False, get_client_ip(request), "Moderate mode blocked")
+            return json_response({
+                "error": "需要授权才能访问此资源",
+                "code": "AUTH_REQUIRED"
+            }, status=401)
+    
+    # 基础模式：只记录
+    elif protection_level == "basic":
+        if is_sensitive:
+            authorized = await check_authorization(request, config)
+            log_attempt(f"{method} {path}", authorized, get_client_ip(request), "Basic mode")
+    
+    return None
 
 def create_protected_handler(original_handler, path):
     """创建受保护的处理器包装"""
     async def protected_handler(request):
-        config = load_config()
-        ip = get_client_ip(request)
-        method = request.method
-        
-        # 如果保护未启用，直接放行
-        if not is_protection_active():
-            return await original_handler(request)
-        
-        protection_level = config.get("protection_level", "strict")
-        
-        # 定义敏感路径
-        sensitive_paths = [
-            '/prompt',      # 工作流执行
-            '/queue',       # 队列
-            '/history',     # 历史记录
-            '/object_info', # 节点信息
-            '/view',        # 查看输出
-        ]
-        
-        is_sensitive = any(path.startswith(sp) for sp in sensitive_paths)
-        
-        # 严格模式
-        if protection_level == "strict":
-            if (is_sensitive or method == 'POST') and not check_authorization(request):
-                log_attempt(f"{method} {path}", False, ip, "Strict mode blocked")
-                return web.json_response({
-                    "error": "需要授权才能执行此操作",
-                    "code": "AUTH_REQUIRED",
-                    "message": "请先通过工作流保护验证"
-                }, status=401)
-        
-        # 中等模式
-        elif protection_level == "moderate":
-            if is_sensitive and not check_authorization(request):
-                log_attempt(f"{method} {path}", False, ip, "Moderate mode blocked")
-                return web.json_response({
-                    "error": "需要授权才能访问此资源",
-                    "code": "AUTH_REQUIRED"
-                }, status=401)
-        
-        # 基础模式：只记录
-        elif protection_level == "basic":
-            if is_sensitive:
-                authorized = check_authorization(request)
-                log_attempt(f"{method} {path}", authorized, ip, f"Basic mode")
-        
+        blocked = await protection_response(request, path)
+        if blocked is not None:
+            return blocked
         return await original_handler(request)
     
     return protected_handler
 
+@web.middleware
+async def protection_middleware(request, handler):
+    """保护中间件 - 按保护级别拦截未授权的敏感请求"""
+    if ROUTE_ENFORCEMENT:
+        blocked = await protection_response(request)
+        if blocked is not None:
+            return blocked
+    return await handler(request)
+
 def install_route_protection():
-    """安装路由保护（通过包装现有路由）"""
+    """安装路由保护（把保护中间件加入 ComfyUI 的 aiohttp 应用）"""
     try:
-        routes = PromptServer.instance.routes
         app = PromptServer.instance.app
+        if protection_middleware not in app.middlewares:
+            app.middlewares.append(protection_middleware)
         
-        # 需要保护的路径
-        protected_paths = ['/prompt', '/queue', '/history', '/object_info', '/view']
-        
-        print("\033[93m[Workflow Protector] 路由保护模式已启用\033[0m")
+        if ROUTE_ENFORCEMENT:
+            print("\033[93m[Workflow Protector] 路由保护模式已启用\033[0m")
         return True
     except Exception as e:
         print(f"\033[91m[Workflow Protector] 路由保护安装失败: {e}\033[0m")
         return False
 
-# 尝试注册中间件（可能在某些ComfyUI版本中有效）
-_middleware_installed = False
-try:
-    # 中间件 - 只处理插件自身的API白名单，不拦截任何ComfyUI原生API
-    @web.middleware
-    async def protection_middleware(request, handler):
-        """保护中间件 - 仅记录日志，不拦截API"""
-        # 直接放行所有请求，保护通过前端实现
-        return await handler(request)
-    
-    _middleware_installed = True
-    print("\033[92m[Workflow Protector] 插件已加载\033[0m")
-except Exception as e:
-    print(f"\033[93m[Workflow Protector] 中间件注册跳过: {e}\033[0m")
+_middleware_installed = install_route_protection()
+print("\033[92m[Workflow Protector] 插件已加载\033[0m")
 
 # ==================== 核心API路由 ====================
 
 @PromptServer.instance.routes.post("/workflow_protector/verify")
+@instrumented("verify")
 async def verify_password_api(request):
     """验证密码并创建会话"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         password = data.get("password", "")
         ip = get_client_ip(request)
         
@@ -483,9 +2865,9 @@ async def verify_password_api(request):
         
         # 未设置密码
         if not config.get("password_hash"):
-            token = create_session(ip)
+            token = await session_call(create_session, ip)
             log_attempt("verify", True, ip, "No password set")
-            response = web.json_response({
+            response = json_response({
                 "success": True, 
                 "message": "未设置保护密码",
                 "token": token,
@@ -496,9 +2878,9 @@ async def verify_password_api(request):
         
         # 保护未启用
         if not config.get("enabled", True):
-            token = create_session(ip)
+            token = await session_call(create_session, ip)
             log_attempt("verify", True, ip, "Protection disabled")
-            response = web.json_response({
+            response = json_response({
                 "success": True, 
                 "message": "保护未启用",
                 "token": token,
@@ -507,11 +2889,17 @@ async def verify_password_api(request):
             response.set_cookie("wp_session", token, max_age=SESSION_DURATION, httponly=True, samesite='Lax')
             return response
         
-        # 验证密码
-        if check_password(password):
-            token = create_session(ip)
+        # 验证密码（超限时在派生密钥之前拒绝）
+        throttled = throttle_response(ip, "verify")
+        if throttled:
+            return throttled
+        
+        password_ok = await run_password_check(ip, check_password, password)
+        _brute_force_limiter.record(ip, password_ok)
+        if password_ok:
+            token = await session_call(create_session, ip)
             log_attempt("verify", True, ip, "Password correct")
-            response = web.json_response({
+            response = json_response({
                 "success": True, 
                 "message": "验证成功",
                 "token": token,
@@ -521,17 +2909,17 @@ async def verify_password_api(request):
             return response
         else:
             log_attempt("verify", False, ip, "Wrong password")
-            await asyncio.sleep(2)  # 增加延迟到2秒，防暴力破解
-            return web.json_response({"success": False, "message": "密码错误"})
+            return json_response({"success": False, "message": "密码错误"})
             
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 @PromptServer.instance.routes.post("/workflow_protector/set_password")
+@instrumented("set_password")
 async def set_password_api(request):
     """设置新密码"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         old_password = data.get("old_password", "")
         new_password = data.get("new_password", "")
         ip = get_client_ip(request)
@@ -539,41 +2927,51 @@ async def set_password_api(request):
         config = load_config()
         
         if config.get("password_hash"):
-            if not check_password(old_password):
+            throttled = throttle_response(ip, "set_password")
+            if throttled:
+                return throttled
+            password_ok = await run_password_check(ip, check_password, old_password)
+            _brute_force_limiter.record(ip, password_ok)
+            if not password_ok:
                 log_attempt("set_password", False, ip, "Wrong old password")
-                await asyncio.sleep(2)
-                return web.json_response({"success": False, "message": "原密码错误"})
+                return json_response({"success": False, "message": "原密码错误"})
         
         if not new_password:
-            return web.json_response({"success": False, "message": "新密码不能为空"})
+            return json_response({"success": False, "message": "新密码不能为空"})
         
         if len(new_password) < 6:
-            return web.json_response({"success": False, "message": "密码长度至少6位"})
-        
-        password_hash, password_salt = hash_password(new_password)
+            return json_response({"success": False, "message": "密码长度至少6位"})
         
-        config["password_hash"] = password_hash
-        config["password_salt"] = password_salt
+        password_hash, password_salt = await run_in_kdf_pool(hash_password, new_password)
         
-        if not config.get("created_at"):
-            config["created_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        async with config_transaction() as current:
+            # 验证原密码期间密码已被其他请求修改
+            if current.get("password_hash") != config.get("password_hash"):
+                return json_response({"success": False, "message": CONFIG_CONFLICT_MESSAGE})
+            
+            current["password_hash"] = password_hash
+            current["password_salt"] = password_salt
+            
+            if not current.get("created_at"):
+                current["created_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
         
-        save_config(config)
-        active_sessions.clear()
+        await session_call(active_sessions.clear)
+        _derived_key_cache.clear()
         
         log_attempt("set_password", True, ip, "Password changed")
         print(f"\033[92m[Workflow Protector] 密码设置成功\033[0m")
-        return web.json_response({"success": True, "message": "密码设置成功"})
+        return json_response({"success": True, "message": "密码设置成功"})
         
     except Exception as e:
         print(f"\033[91m[Workflow Protector] 设置密码异常: {e}\033[0m")
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 @PromptServer.instance.routes.post("/workflow_protector/toggle")
+@instrumented("toggle")
 async def toggle_protection(request):
     """开关保护功能"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         password = data.get("password", "")
         enabled = data.get("enabled", True)
         ip = get_client_ip(request)
@@ -581,94 +2979,157 @@ async def toggle_protection(request):
         config = load_config()
         
         if config.get("password_hash"):
-            if not check_password(password):
+            throttled = throttle_response(ip, "toggle")
+            if throttled:
+                return throttled
+            password_ok = await run_password_check(ip, check_password, password)
+            _brute_force_limiter.record(ip, password_ok)
+            if not password_ok:
                 log_attempt("toggle", False, ip, "Wrong password")
-                return web.json_response({"success": False, "message": "密码错误"})
+                return json_response({"success": False, "message": "密码错误"})
         
-        config["enabled"] = enabled
-        save_config(config)
+        async with config_transaction() as current:
+            if current.get("password_hash") != config.get("password_hash"):
+                return json_response({"success": False, "message": CONFIG_CONFLICT_MESSAGE})
+            current["enabled"] = enabled
         
         if not enabled:
-            active_sessions.clear()
+            await session_call(active_sessions.clear)
         
         status = "启用" if enabled else "禁用"
         log_attempt("toggle", True, ip, f"Protection {status}")
-        return web.json_response({"success": True, "message": f"保护已{status}"})
+        return json_response({"success": True, "message": f"保护已{status}"})
         
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 @PromptServer.instance.routes.get("/workflow_protector/status")
 async def get_status(request):
-    """获取保护状态"""
-    config = load_config()
-    is_authorized = check_authorization(request)
+    """获取保护状态
+    
+    响应带 ETag，请求携带相同的 If-None-Match 时返回304。
+    同时带 wait=秒 参数时为长轮询：状态未变化则挂起，直到配置变更或超时（超时返回304）。
+    本进程保存配置时立即唤醒，其他进程的修改和会话过期在 STATUS_POLL_INTERVAL 内发现。
+    """
+    status, etag = await _status_snapshot(request)
+    if_none_match = request.headers.get("If-None-Match")
+    
+    try:
+        wait = min(max(float(request.query.get("wait", 0)), 0), STATUS_LONG_POLL_MAX)
+    except ValueError:
+        wait = 0
     
-    return web.json_response({
+    if wait and if_none_match == etag:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while etag == if_none_match:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            await wait_status_change(min(remaining, STATUS_POLL_INTERVAL))
+            # 授权结果缓存在请求上，状态变化后需要重新验证
+            request.pop(_AUTH_REQUEST_KEY, None)
+            status, etag = await _status_snapshot(request)
+    
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match == etag:
+        return web.Response(status=304, headers=headers)
+    return json_response(status, headers=headers)
+
+async def _status_snapshot(request):
+    """当前状态及其ETag（包含该请求的授权状态）
+    
+    ETag 只覆盖配置和该请求的授权状态；会话计数变化不会唤醒长轮询，不参与比较。
+    """
+    config = load_config()
+    status = {
         "has_password": config.get("password_hash") is not None,
         "enabled": config.get("enabled", True),
         "protection_level": config.get("protection_level", "strict"),
-        "is_authorized": is_authorized,
-        "session_duration": SESSION_DURATION,
-        "active_sessions": len(active_sessions)
-    })
+        "is_authorized": await check_authorization(request, config),
+        "session_duration": SESSION_DURATION
+    }
+    digest = hashlib.sha1(json.dumps(status, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    session_stats = await session_call(active_sessions.stats)
+    status["active_sessions"] = session_stats["live"]
+    status["expired_sessions"] = session_stats["expired"]
+    return status, f'W/"{digest}"'
 
 @PromptServer.instance.routes.post("/workflow_protector/clear_password")
+@instrumented("clear_password")
 async def clear_password(request):
     """清除密码"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         password = data.get("password", "")
         ip = get_client_ip(request)
         
         config = load_config()
         
         if config.get("password_hash"):
-            if not check_password(password):
+            throttled = throttle_response(ip, "clear_password")
+            if throttled:
+                return throttled
+            password_ok = await run_password_check(ip, check_password, password)
+            _brute_force_limiter.record(ip, password_ok)
+            if not password_ok:
                 log_attempt("clear_password", False, ip, "Wrong password")
-                return web.json_response({"success": False, "message": "密码错误"})
+                return json_response({"success": False, "message": "密码错误"})
         
-        config["password_hash"] = None
-        config["password_salt"] = None
-        save_config(config)
-        active_sessions.clear()
+        async with config_transaction() as current:
+            if current.get("password_hash") != config.get("password_hash"):
+                return json_response({"success": False, "message": CONFIG_CONFLICT_MESSAGE})
+            current["password_hash"] = None
+            current["password_salt"] = None
+        
+        await session_call(active_sessions.clear)
+        _derived_key_cache.clear()
         
         log_attempt("clear_password", True, ip, "Password cleared")
-        return web.json_response({"success": True, "message": "密码已清除"})
+        return json_response({"success": True, "message": "密码已清除"})
         
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 @PromptServer.instance.routes.post("/workflow_protector/set_level")
+@instrumented("set_level")
 async def set_protection_level(request):
     """设置保护级别"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         password = data.get("password", "")
         level = data.get("level", "strict")
         ip = get_client_ip(request)
         
         if level not in ["strict", "moderate", "basic"]:
-            return web.json_response({"success": False, "message": "无效的保护级别"})
+            return json_response({"success": False, "message": "无效的保护级别"})
         
         config = load_config()
         
         if config.get("password_hash"):
-            if not check_password(password):
-                return web.json_response({"success": False, "message": "密码错误"})
+            throttled = throttle_response(ip, "set_level")
+            if throttled:
+                return throttled
+            password_ok = await run_password_check(ip, check_password, password)
+            _brute_force_limiter.record(ip, password_ok)
+            if not password_ok:
+                log_attempt("set_level", False, ip, "Wrong password")
+                return json_response({"success": False, "message": "密码错误"})
         
-        config["protection_level"] = level
-        save_config(config)
+        async with config_transaction() as current:
+            if current.get("password_hash") != config.get("password_hash"):
+                return json_response({"success": False, "message": CONFIG_CONFLICT_MESSAGE})
+            current["protection_level"] = level
         
         level_names = {"strict": "严格", "moderate": "中等", "basic": "基础"}
         log_attempt("set_level", True, ip, f"Level: {level}")
-        return web.json_response({
+        return json_response({
             "success": True, 
             "message": f"保护级别已设置为: {level_names.get(level, level)}"
         })
         
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 @PromptServer.instance.routes.post("/workflow_protector/logout")
 async def logout(request):
@@ -679,132 +3140,1236 @@ async def logout(request):
     )
     ip = get_client_ip(request)
     
-    if token and token in active_sessions:
-        del active_sessions[token]
+    if token and await session_call(active_sessions.pop, token) is not None:
         log_attempt("logout", True, ip, "Session destroyed")
+    if token:
+        _decrypted_cache.drop_session(token)
     
-    response = web.json_response({"success": True, "message": "已登出"})
+    response = json_response({"success": True, "message": "已登出"})
     response.del_cookie("wp_session")
     return response
 
 @PromptServer.instance.routes.get("/workflow_protector/logs")
 async def get_logs(request):
-    """获取访问日志"""
-    if not check_authorization(request):
-        return web.json_response({"success": False, "message": "需要授权"}, status=401)
+    """获取访问日志
+    
+    查询参数: limit（默认100）、offset、ip、action、success、since、until
+    """
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    # 先写出队列中的日志，保证能看到最新记录
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _log_writer.flush)
+    
+    try:
+        query = request.query
+        limit = min(max(int(query.get("limit", 100)), 1), LOG_QUERY_MAX)
+        offset = max(int(query.get("offset", 0)), 0)
+        success = query.get("success")
+        if success is not None:
+            success = success.lower() in ("1", "true", "yes")
+        
+        lines, has_more = await loop.run_in_executor(None, functools.partial(
+            query_logs, limit, offset,
+            ip=query.get("ip"),
+            action=query.get("action"),
+            success=success,
+            since=query.get("since"),
+            until=query.get("until")
+        ))
+        records = [parse_log_line(line) for line in lines]
+        return json_response({
+            "success": True,
+            "logs": [format_log_record(r) if r else line for r, line in zip(records, lines)],
+            "records": [r for r in records if r],
+            "has_more": has_more,
+            "next_offset": offset + len(lines)
+        })
+    except Exception as e:
+        return json_response({"success": False, "message": str(e)})
+
+@PromptServer.instance.routes.get("/workflow_protector/logs/stats")
+async def get_logs_stats(request):
+    """访问日志聚合统计
     
-    log_file = os.path.join(CONFIG_DIR, ".wp_access.log")
+    查询参数: since（排除更早的历史日志段）、minutes（每分钟速率的时间窗口，默认60）
+    """
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
     
-    if not os.path.exists(log_file):
-        return web.json_response({"success": True, "logs": []})
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _log_writer.flush)
     
     try:
-        with open(log_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()[-100:]
-        return web.json_response({"success": True, "logs": [l.strip() for l in lines]})
+        minutes = min(max(int(request.query.get("minutes", 60)), 1), 1440)
+        stats = await loop.run_in_executor(
+            None, functools.partial(aggregate_logs, request.query.get("since"), minutes)
+        )
+        return json_response({"success": True, **stats})
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
+
+@PromptServer.instance.routes.get("/workflow_protector/metrics")
+async def get_metrics(request):
+    """Prometheus 格式的运行指标
+    
+    设置了 WP_METRICS_TOKEN 时可用 "Authorization: Bearer <令牌>" 访问，否则需要会话授权。
+    """
+    bearer = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not (METRICS_TOKEN and hmac.compare_digest(bearer, METRICS_TOKEN)) and not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    # 存储索引首次读取或重建可能较慢，整体放到线程池
+    text = await asyncio.get_running_loop().run_in_executor(None, collect_metrics)
+    return web.Response(text=text, content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
 
 @PromptServer.instance.routes.post("/workflow_protector/clear_logs")
 async def clear_logs(request):
     """清除日志"""
-    if not check_authorization(request):
-        return web.json_response({"success": False, "message": "需要授权"}, status=401)
-    
-    log_file = os.path.join(CONFIG_DIR, ".wp_access.log")
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
     
     try:
-        if os.path.exists(log_file):
-            os.remove(log_file)
-        return web.json_response({"success": True, "message": "日志已清除"})
+        # 后台线程正在切分时需等待其完成
+        await asyncio.get_running_loop().run_in_executor(None, _log_writer.remove)
+        return json_response({"success": True, "message": "日志已清除"})
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 # ==================== 工作流加密API ====================
 
 @PromptServer.instance.routes.post("/workflow_protector/encrypt")
+@instrumented("encrypt")
 async def encrypt_workflow(request):
-    """加密工作流"""
+    """加密工作流
+    
+    请求体为 application/octet-stream 时按流式接口处理；
+    请求 "format": "binary" 或 Accept: application/octet-stream 时返回二进制容器。
+    """
+    if request.content_type == "application/octet-stream":
+        return await _encrypt_stream(request, "encrypt")
+    
     try:
-        data = await request.json()
+        data = await read_json(request)
         workflow = data.get("workflow")
         password = data.get("password", "")
         
         if not workflow:
-            return web.json_response({"success": False, "message": "工作流数据为空"})
+            return json_response({"success": False, "message": "工作流数据为空"})
         
         if not password:
-            return web.json_response({"success": False, "message": "加密密码不能为空"})
+            return json_response({"success": False, "message": "加密密码不能为空"})
         
         if len(password) < 4:
-            return web.json_response({"success": False, "message": "密码至少4位"})
+            return json_response({"success": False, "message": "密码至少4位"})
+        
+        ip = get_client_ip(request)
+        
+        if _wants_binary(request, data):
+            if not HAS_CRYPTO:
+                return json_response({"success": False, "message": "二进制格式需要cryptography库: pip install cryptography"})
+            
+            container = await run_in_kdf_pool(
+                WorkflowEncryption.encrypt_to_container, workflow, password,
+                data.get("compression"), data.get("compression_level")
+            )
+            log_attempt("encrypt", True, ip, "Workflow encrypted (binary)")
+            return web.Response(body=container, content_type="application/octet-stream")
         
         # 加密工作流（便携模式，可跨机器使用）
-        encrypted = WorkflowEncryption.encrypt_workflow(workflow, password)
+        encrypted = await run_in_kdf_pool(
+            WorkflowEncryption.encrypt_workflow, workflow, password,
+            compression=data.get("compression"),
+            compression_level=data.get("compression_level")
+        )
         
-        ip = get_client_ip(request)
         log_attempt("encrypt", True, ip, "Workflow encrypted")
         
-        return web.json_response({
+        return json_response({
             "success": True, 
             "message": "加密成功",
             "encrypted": encrypted
         })
         
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
 
 @PromptServer.instance.routes.post("/workflow_protector/decrypt")
+@instrumented("decrypt")
 async def decrypt_workflow(request):
-    """解密工作流"""
+    """解密工作流
+    
+    请求体为 application/octet-stream（二进制容器）时按流式接口处理，
+    直接返回工作流JSON原始字节。
+    """
+    if request.content_type == "application/octet-stream":
+        return await _decrypt_stream(request, "decrypt")
+    
     try:
-        data = await request.json()
+        data = await read_json(request)
         encrypted_workflow = data.get("workflow")
         password = data.get("password", "")
         
         if not encrypted_workflow:
-            return web.json_response({"success": False, "message": "工作流数据为空"})
+            return json_response({"success": False, "message": "工作流数据为空"})
         
         if not password:
-            return web.json_response({"success": False, "message": "解密密码不能为空"})
-        
-        # 解密工作流（便携模式，可跨机器使用）
-        workflow, error = WorkflowEncryption.decrypt_workflow(encrypted_workflow, password)
+            return json_response({"success": False, "message": "解密密码不能为空"})
         
         ip = get_client_ip(request)
+        throttled = throttle_response(ip, "decrypt")
+        if throttled:
+            return throttled
+        
+        # 解密工作流（便携模式，可跨机器使用）
+        workflow, error = await run_password_check(
+            ip, WorkflowEncryption.decrypt_workflow, encrypted_workflow, password
+        )
+        record_decrypt_result(ip, error)
         
         if error:
             log_attempt("decrypt", False, ip, error)
-            await asyncio.sleep(1)  # 防暴力破解
-            return web.json_response({"success": False, "message": error})
+            return json_response({"success": False, "message": error})
         
         log_attempt("decrypt", True, ip, "Workflow decrypted")
         
-        return web.json_response({
+        return json_response({
             "success": True, 
             "message": "解密成功",
             "workflow": workflow
         })
         
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
+
+@PromptServer.instance.routes.post("/workflow_protector/rekey")
+@instrumented("rekey")
+async def rekey_workflow(request):
+    """更换加密工作流的密码（keep_old 时为添加密码）
+    
+    包装格式只改写头部，数据块不重新加密；旧格式文件会完整解密后重新加密。
+    """
+    try:
+        data = await read_json(request)
+        encrypted_workflow = data.get("workflow")
+        password = data.get("password", "")
+        new_password = data.get("new_password", "")
+        
+        if not encrypted_workflow:
+            return json_response({"success": False, "message": "工作流数据为空"})
+        
+        if not password:
+            return json_response({"success": False, "message": "原密码不能为空"})
+        
+        if len(new_password) < 4:
+            return json_response({"success": False, "message": "新密码至少4位"})
+        
+        ip = get_client_ip(request)
+        throttled = throttle_response(ip, "rekey")
+        if throttled:
+            return throttled
+        
+        workflow, error = await run_password_check(
+            ip, WorkflowEncryption.rekey_workflow, encrypted_workflow, password, new_password,
+            bool(data.get("keep_old"))
+        )
+        record_decrypt_result(ip, error)
+        
+        if error:
+            log_attempt("rekey", False, ip, error)
+            return json_response({"success": False, "message": error})
+        
+        log_attempt("rekey", True, ip, "Workflow password changed")
+        
+        return json_response({
+            "success": True,
+            "message": "密码已更换",
+            "workflow": workflow
+        })
+        
+    except Exception as e:
+        return json_response({"success": False, "message": str(e)})
+
+def _wants_binary(request, data):
+    """客户端是否要求返回二进制容器"""
+    if data.get("format") == "binary":
+        return True
+    return "application/octet-stream" in request.headers.get("Accept", "")
+
+def _stream_password(request):
+    """流式接口的密码通过 X-WP-Password 头传递（URL编码，支持非ASCII字符）"""
+    return urllib.parse.unquote(request.headers.get("X-WP-Password", ""))
+
+@PromptServer.instance.routes.post("/workflow_protector/encrypt_stream")
+@instrumented("encrypt_stream")
+async def encrypt_workflow_stream(request):
+    """流式加密工作流：请求体为工作流JSON原始字节，响应为V2二进制流"""
+    return await _encrypt_stream(request, "encrypt_stream")
+
+async def _encrypt_stream(request, action):
+    """流式加密的实现（不计入指标，/encrypt 收到二进制请求时也调用）
+    
+    action 为调用方路由的名称，使访问日志中的接口名与指标一致。
+    """
+    password = _stream_password(request)
+    ip = get_client_ip(request)
+    
+    if not HAS_CRYPTO:
+        return json_response({"success": False, "message": "流式加密需要cryptography库: pip install cryptography"})
+    
+    if len(password) < 4:
+        return json_response({"success": False, "message": "密码至少4位"})
+    
+    compression = request.headers.get("X-WP-Compression", DEFAULT_COMPRESSION)
+    compression_level = request.headers.get("X-WP-Compression-Level")
+    
+    try:
+        key, header = await run_in_kdf_pool(WorkflowEncryption.new_stream_header, password, compression)
+        encryptor = StreamEncryptor(key, header, compression_level)
+    except Exception as e:
+        return json_response({"success": False, "message": str(e)})
+    
+    header["hint"] = WorkflowEncryption.HINT
+    response = web.StreamResponse(headers={"Content-Type": "application/octet-stream"})
+    await response.prepare(request)
+    await response.write(WorkflowEncryption.pack_stream_header(header))
+    
+    total = 0
+    async for data in request.content.iter_chunked(STREAM_CHUNK_SIZE):
+        total += len(data)
+        for sealed in encryptor.update(data):
+            await response.write(WorkflowEncryption.pack_frame(sealed, False))
+    await response.write(WorkflowEncryption.pack_frame(encryptor.finalize(), True))
+    await response.write_eof()
+    
+    log_attempt(action, True, ip, f"Workflow encrypted ({total} bytes)")
+    return response
+
+@PromptServer.instance.routes.post("/workflow_protector/decrypt_stream")
+@instrumented("decrypt_stream")
+async def decrypt_workflow_stream(request):
+    """流式解密工作流：请求体为V2二进制流，响应为工作流JSON原始字节
+    
+    第一块通过认证后才开始发送响应；之后若有数据块认证失败，连接会被直接中断，
+    客户端不会收到被篡改的内容。
+    """
+    return await _decrypt_stream(request, "decrypt_stream")
+
+async def _decrypt_stream(request, action):
+    """流式解密的实现（不计入指标，/decrypt 收到二进制请求时也调用）
+    
+    action 为调用方路由的名称，使限流和访问日志中的接口名与指标一致。
+    """
+    password = _stream_password(request)
+    ip = get_client_ip(request)
+    
+    if not password:
+        return json_response({"success": False, "message": "解密密码不能为空"})
+    
+    throttled = throttle_response(ip, action)
+    if throttled:
+        return throttled
+    
+    parser = StreamParser()
+    decryptor = None
+    key_cached = True
+    response = None
+    
+    try:
+        async for data in request.content.iter_chunked(STREAM_CHUNK_SIZE):
+            for event in parser.feed(data):
+                if event[0] == "header":
+                    key, key_cached = await run_password_check(ip, WorkflowEncryption.stream_key, event[1], password)
+                    decryptor = StreamDecryptor(key, event[1])
+                    continue
+                
+                plaintext = decryptor.decrypt_chunk(event[1], event[2])
+                if not key_cached:
+                    _derived_key_cache.put(password, parser.header["salt"], key)
+                    key_cached = True
+                
+                if response is None:
+                    _brute_force_limiter.record(ip, True)
+                    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+                    await response.prepare(request)
+                await response.write(plaintext)
+        parser.close()
+    except (DecryptionError, KDFBusyError) as e:
+        log_attempt(action, False, ip, str(e))
+        if response is not None:
+            raise
+        # KDFBusyError 的令牌已由 run_password_check 退还
+        if isinstance(e, DecryptionError):
+            record_decrypt_result(ip, str(e))
+        return json_response({"success": False, "message": str(e)})
+    
+    await response.write_eof()
+    log_attempt(action, True, ip, "Workflow decrypted")
+    return response
+
+# check_encrypted 只读取请求体开头的这些字节来判断，明文工作流无需完整解析
+SNIFF_BYTES = 4096
+_SNIFF_MARKER = b"COMFYUI_PROTECTED_WORKFLOW_V"
+# {"workflow": {"第一个键"  —— 加密信封的第一个键总是以下划线开头（_protected 或排序后的 _chunks 等）
+_SNIFF_FIRST_KEY_RE = re.compile(rb'^\s*\{\s*"workflow"\s*:\s*\{\s*"([^"\\]*)"(?:\s*:\s*"([^"\\]*)")?')
+
+def sniff_encrypted(prefix):
+    """根据请求体开头判断是否为加密工作流，返回 True / False，无法确定时返回None"""
+    if prefix.startswith(STREAM_MAGIC):
+        return True
+    
+    match = _SNIFF_FIRST_KEY_RE.match(prefix)
+    if match is None:
+        return None
+    key, value = match.group(1), match.group(2)
+    if key == b"_protected" and value is not None:
+        return value.decode('utf-8') in (WorkflowEncryption.MAGIC_HEADER, WorkflowEncryption.MAGIC_HEADER_V2)
+    if not key.startswith(b"_") and _SNIFF_MARKER not in prefix:
+        return False
+    return None
 
 @PromptServer.instance.routes.post("/workflow_protector/check_encrypted")
 async def check_encrypted(request):
-    """检查工作流是否已加密"""
+    """检查工作流是否已加密
+    
+    先只读取请求体开头（SNIFF_BYTES）：二进制容器或第一个键不是下划线开头的明文工作流
+    可直接得出结论，不会缓冲和解析整个工作流；只有可能是加密信封时才完整解析确认。
+    """
     try:
-        data = await request.json()
-        workflow = data.get("workflow")
+        prefix = b""
+        while len(prefix) < SNIFF_BYTES:
+            data = await request.content.read(SNIFF_BYTES - len(prefix))
+            if not data:
+                break
+            prefix += data
         
-        is_encrypted = WorkflowEncryption.is_encrypted(workflow)
+        is_encrypted = sniff_encrypted(prefix) if len(prefix) == SNIFF_BYTES else None
+        if is_encrypted is None:
+            body = prefix + await request.content.read()
+            if body.startswith(STREAM_MAGIC):
+                is_encrypted = True
+            else:
+                workflow = json_loads(body).get("workflow")
+                is_encrypted = WorkflowEncryption.is_encrypted(workflow)
         
-        return web.json_response({
+        return json_response({
             "success": True,
             "encrypted": is_encrypted
         })
         
     except Exception as e:
-        return web.json_response({"success": False, "message": str(e)})
+        return json_response({"success": False, "message": str(e)})
+
+# ==================== 批量加解密 ====================
+
+BATCH_MAX_WORKERS = max(1, int(os.environ.get("WP_BATCH_WORKERS", str(os.cpu_count() or 2))))
+# 同时运行的批量任务数：每个批量任务自带最多 BATCH_MAX_WORKERS 个线程做PBKDF2，
+# 超出时与密钥派生线程池一样直接返回“服务器繁忙”，线程数不会随并发请求无限增长
+BATCH_MAX_CONCURRENT = max(1, int(os.environ.get("WP_BATCH_MAX_CONCURRENT", "1")))
+_batch_slots = threading.BoundedSemaphore(BATCH_MAX_CONCURRENT)
+ENCRYPTED_SUFFIX = "_encrypted"
+DECRYPTED_SUFFIX = "_decrypted"
+CONTAINER_EXTENSION = ".wpenc"
+
+def batch_output_path(src, mode, output_dir=None, binary=False):
+    """批量处理时的输出文件路径（与前端一致，加密文件添加 _encrypted 后缀，更换密码时文件名不变）"""
+    if mode == "rekey":
+        return os.path.join(output_dir or os.path.dirname(src), os.path.basename(src))
+    base, _ = os.path.splitext(os.path.basename(src))
+    if mode == "encrypt":
+        name = base + ENCRYPTED_SUFFIX + (CONTAINER_EXTENSION if binary else ".json")
+    else:
+        if base.endswith(ENCRYPTED_SUFFIX):
+            base = base[:-len(ENCRYPTED_SUFFIX)]
+        name = base + DECRYPTED_SUFFIX + ".json"
+    return os.path.join(output_dir or os.path.dirname(src), name)
+
+def collect_batch_files(paths, mode, recursive=False):
+    """收集待处理的工作流文件（目录中的 .json，解密时额外包含 .wpenc）"""
+    extensions = (".json",) if mode == "encrypt" else (".json", CONTAINER_EXTENSION)
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            for name in sorted(names):
+                stem = os.path.splitext(name)[0]
+                if not name.endswith(extensions):
+                    continue
+                # 跳过自己生成的输出文件
+                if mode == "encrypt" and stem.endswith(ENCRYPTED_SUFFIX):
+                    continue
+                if mode != "encrypt" and stem.endswith(DECRYPTED_SUFFIX):
+                    continue
+                files.append(os.path.join(root, name))
+            if not recursive:
+                break
+    return files
+
+def process_batch_item(item, password, mode, keyring=None, version=None, compression=None,
+                       compression_level=None, binary=False, overwrite=False,
+                       new_password=None, keep_old=False, new_keyring=None):
+    """处理批量任务中的一个工作流，返回结果字典（不会抛出异常）
+    
+    item 为 {"name", "workflow"}（结果中返回 output）或 {"name", "src", "dst"}（读写文件）。
+    mode 为 "rekey" 时把 password 换成 new_password，默认原地改写文件。
+    """
+    src = item.get("src")
+    dst = item.get("dst")
+    result = {"name": item.get("name") or src, "success": False}
+    start = time.perf_counter()
+    
+    try:
+        if dst and not overwrite and os.path.exists(dst) and not (mode == "rekey" and dst == src):
+            raise FileExistsError(f"输出文件已存在: {dst}")
+        
+        raw = None
+        if src:
+            with open(src, 'rb') as f:
+                raw = f.read()
+            result["bytes"] = len(raw)
+        
+        if mode == "encrypt":
+            workflow = json_loads(raw) if raw is not None else item.get("workflow")
+            if not workflow:
+                raise ValueError("工作流数据为空")
+            if WorkflowEncryption.is_encrypted(workflow):
+                result["skipped"] = True
+                raise ValueError("工作流已加密，已跳过")
+            
+            if binary:
+                output = WorkflowEncryption.encrypt_to_container(
+                    workflow, password, compression, compression_level, keyring
+                )
+            else:
+                output = WorkflowEncryption.encrypt_workflow(
+                    workflow, password, version=version, compression=compression,
+                    compression_level=compression_level, keyring=keyring
+                )
+        elif mode == "rekey":
+            if raw is not None and raw.startswith(STREAM_MAGIC):
+                output = WorkflowEncryption.rekey_container(
+                    raw, password, new_password, keep_old, keyring, new_keyring
+                )
+            else:
+                encrypted = json_loads(raw) if raw is not None else item.get("workflow")
+                if not WorkflowEncryption.is_encrypted(encrypted):
+                    result["skipped"] = True
+                    raise ValueError("不是加密的工作流文件，已跳过")
+                output, error = WorkflowEncryption.rekey_workflow(
+                    encrypted, password, new_password, keep_old, keyring, new_keyring
+                )
+                if error:
+                    raise DecryptionError(error)
+        else:
+            if raw is not None and raw.startswith(STREAM_MAGIC):
+                plaintext = b"".join(WorkflowEncryption.iter_decrypt_stream([raw], password, keyring))
+                output = json_loads(plaintext)
+            else:
+                encrypted = json_loads(raw) if raw is not None else item.get("workflow")
+                if not WorkflowEncryption.is_encrypted(encrypted):
+                    result["skipped"] = True
+                    raise ValueError("不是加密的工作流文件，已跳过")
+                output, error = WorkflowEncryption.decrypt_workflow(encrypted, password, keyring=keyring)
+                if error:
+                    raise DecryptionError(error)
+        
+        if dst:
+            if not isinstance(output, bytes):
+                output = json_dumps(output)
+            # 先写临时文件再替换，原地更换密码时中途失败不会损坏原文件
+            fd, tmp_path = tempfile.mkstemp(prefix=".wp_batch_", dir=os.path.dirname(dst) or ".")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(output)
+                os.replace(tmp_path, dst)
+            except:
+                os.unlink(tmp_path)
+                raise
+            result["output_path"] = dst
+        else:
+            result["output"] = output
+        
+        result["success"] = True
+    except Exception as e:
+        result["message"] = str(e)
+    
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
+
+def summarize_batch(results, elapsed, total_bytes=None):
+    """汇总批量处理结果与吞吐量"""
+    if total_bytes is None:
+        total_bytes = sum(r.get("bytes", 0) for r in results)
+    succeeded = sum(1 for r in results if r["success"])
+    skipped = sum(1 for r in results if r.get("skipped"))
+    return {
+        "files": len(results),
+        "succeeded": succeeded,
+        "skipped": skipped,
+        "failed": len(results) - succeeded - skipped,
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 4),
+        "files_per_second": round(len(results) / elapsed, 2) if elapsed > 0 else None,
+        "mb_per_second": round(total_bytes / elapsed / 1048576, 3) if elapsed > 0 else None
+    }
+
+def run_batch(items, password, mode, shared_salt=False, workers=None, total_bytes=None, **options):
+    """使用线程池并行处理一批工作流，返回 (results, summary)
+    
+    PBKDF2、AES 与 zlib 都会释放GIL，线程即可利用多核；
+    命令行工具 tools/wp_batch.py 使用进程池。
+    """
+    start = time.perf_counter()
+    keyring = KeyRing(password, shared_salt=shared_salt and mode == "encrypt")
+    new_keyring = None
+    if mode == "rekey":
+        # 新密码只用来包装各文件的数据密钥，整批共用一个盐，只派生一次
+        new_keyring = KeyRing(options["new_password"], shared_salt=True)
+        options["new_keyring"] = new_keyring
+    workers = max(1, min(workers or BATCH_MAX_WORKERS, len(items) or 1))
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wp-batch") as executor:
+        results = list(executor.map(
+            lambda item: process_batch_item(item, password, mode, keyring, **options),
+            items
+        ))
+    
+    summary = summarize_batch(results, time.perf_counter() - start, total_bytes)
+    summary["key_derivations"] = keyring.derivations + (new_keyring.derivations if new_keyring else 0)
+    summary["workers"] = workers
+    return results, summary
+
+@contextlib.contextmanager
+def batch_slot():
+    """占用一个批量任务名额，已满时抛出 KDFBusyError（计入密钥派生的拒绝次数）"""
+    if not _batch_slots.acquire(blocking=False):
+        with _kdf_lock:
+            _kdf_stats["rejected"] += 1
+        raise KDFBusyError("服务器繁忙，请稍后重试")
+    try:
+        yield
+    finally:
+        _batch_slots.release()
+
+def record_batch_result(ip, results):
+    """整批使用同一个密码，按一次尝试登记：有文件成功即密码正确，全部因密码错误失败才计入失败"""
+    if any(r["success"] for r in results):
+        _brute_force_limiter.record(ip, True)
+    elif any(is_password_failure(r.get("message")) for r in results):
+        _brute_force_limiter.record(ip, False)
+    else:
+        _brute_force_limiter.release(ip)
+
+def _resolve_user_directory(directory):
+    """批量接口的目录参数必须位于 ComfyUI 用户目录内"""
+    if folder_paths is None or not hasattr(folder_paths, "get_user_directory"):
+        raise ValueError("当前ComfyUI版本不支持目录批量处理")
+    
+    user_dir = os.path.realpath(folder_paths.get_user_directory())
+    path = os.path.realpath(os.path.join(user_dir, directory))
+    if os.path.commonpath([user_dir, path]) != user_dir or not os.path.isdir(path):
+        raise ValueError("目录必须位于ComfyUI用户目录内")
+    return path
+
+@PromptServer.instance.routes.post("/workflow_protector/batch")
+@instrumented("batch")
+async def batch_workflows(request):
+    """批量加密/解密/更换密码
+    
+    参数: mode ("encrypt"/"decrypt"/"rekey"), password, shared_salt, new_password, keep_old（rekey 时）,
+    workflows（{名称: 工作流} 或列表）或 directory（ComfyUI用户目录下的相对路径）
+    """
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    try:
+        data = await read_json(request)
+        mode = data.get("mode", "encrypt")
+        password = data.get("password", "")
+        workflows = data.get("workflows")
+        directory = data.get("directory")
+        ip = get_client_ip(request)
+        
+        if mode not in ("encrypt", "decrypt", "rekey"):
+            return json_response({"success": False, "message": "无效的模式"})
+        
+        if len(password) < 4:
+            return json_response({"success": False, "message": "密码至少4位"})
+        
+        if mode == "rekey" and len(data.get("new_password") or "") < 4:
+            return json_response({"success": False, "message": "新密码至少4位"})
+        
+        binary = data.get("format") == "binary"
+        options = {
+            "version": data.get("version"),
+            "compression": data.get("compression"),
+            "compression_level": data.get("compression_level"),
+            "binary": binary,
+            "overwrite": bool(data.get("overwrite"))
+        }
+        if mode == "rekey":
+            options["new_password"] = data["new_password"]
+            options["keep_old"] = bool(data.get("keep_old"))
+        
+        total_bytes = None
+        workers = min(int(data.get("workers") or BATCH_MAX_WORKERS), BATCH_MAX_WORKERS)
+        
+        if workflows:
+            if binary:
+                return json_response({"success": False, "message": "二进制格式仅支持目录模式"})
+            if isinstance(workflows, dict):
+                items = [{"name": name, "workflow": wf} for name, wf in workflows.items()]
+            else:
+                items = [{"name": str(i), "workflow": wf} for i, wf in enumerate(workflows)]
+            total_bytes = request.content_length
+        elif directory:
+            path = _resolve_user_directory(directory)
+            files = collect_batch_files([path], mode, recursive=bool(data.get("recursive")))
+            items = [
+                {"name": os.path.relpath(f, path), "src": f, "dst": batch_output_path(f, mode, binary=binary)}
+                for f in files
+            ]
+        else:
+            return json_response({"success": False, "message": "工作流数据为空"})
+        
+        with batch_slot():
+            # 解密/更换密码会校验密码，与单个文件的接口一样限流（未启用保护时任何人都能调用）
+            if mode != "encrypt":
+                throttled = throttle_response(ip, f"batch_{mode}")
+                if throttled:
+                    return throttled
+            
+            loop = asyncio.get_running_loop()
+            try:
+                results, summary = await loop.run_in_executor(None, functools.partial(
+                    run_batch, items, password, mode,
+                    shared_salt=bool(data.get("shared_salt")),
+                    workers=workers,
+                    total_bytes=total_bytes,
+                    **options
+                ))
+            except:
+                if mode != "encrypt":
+                    _brute_force_limiter.release(ip)
+                raise
+        
+        if mode != "encrypt":
+            record_batch_result(ip, results)
+        
+        log_attempt(f"batch_{mode}", summary["failed"] == 0, ip,
+                    f"{summary['succeeded']}/{summary['files']} files")
+        return json_response({"success": True, "results": results, "summary": summary})
+        
+    except Exception as e:
+        return json_response({"success": False, "message": str(e)})
+
+# ==================== 加密工作流存储 ====================
+
+# 按内容哈希保存加密后的工作流，客户端之后只需传ID，不必反复上传/下载整个加密文件
+STORE_DIR = os.path.join(CONFIG_DIR, ".wp_store")
+STORE_INDEX_FILE = os.path.join(STORE_DIR, "index.json")
+STORE_MAX_BYTES = int(os.environ.get("WP_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# 每个已授权会话缓存的解密结果（条目数 / 总字节数），以及最多跟踪的会话数
+STORE_CACHE_ENTRIES = int(os.environ.get("WP_STORE_CACHE_ENTRIES", "16"))
+STORE_CACHE_BYTES = int(os.environ.get("WP_STORE_CACHE_BYTES", str(64 * 1024 * 1024)))
+STORE_CACHE_SESSIONS = 32
+_STORE_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class WorkflowStore:
+    """按内容寻址的加密工作流存储
+    
+    对象以内容的 SHA-256 为ID保存在 .wp_store/<ID前两位>/<ID>，相同密文只保存一份。
+    V2 统一保存为二进制容器（JSON封装上传时先转换），V1 保存为规范化JSON。
+    index.json 记录元数据（格式、版本、加密方式、盐、大小、创建时间），列表和查询不读对象文件；
+    索引丢失或损坏时扫描对象文件重建。
+    
+    多个进程可共用同一目录：索引文件变化（其他进程替换）时重新读取，
+    写入和重建在 .lock 文件锁内完成。首次读取或重建可能较慢，所有方法都应在线程池中调用。
+    """
+    
+    def __init__(self, root=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        self.lock_path = os.path.join(root, ".lock")
+        self.max_bytes = max_bytes
+        self._index = None
+        self._index_signature = None
+        self._lock = threading.Lock()
+        self._file_locked = False
+    
+    def _object_path(self, object_id):
+        return os.path.join(self.root, object_id[:2], object_id)
+    
+    @staticmethod
+    def canonicalize(encrypted_workflow):
+        """加密工作流（JSON封装或二进制容器）→ 存储用字节，不需要密码"""
+        if isinstance(encrypted_workflow, (bytes, bytearray)):
+            read_stream_header(encrypted_workflow)
+            return bytes(encrypted_workflow)
+        if not WorkflowEncryption.is_encrypted(encrypted_workflow):
+            raise ValueError("不是加密的工作流文件")
+        if encrypted_workflow.get("_protected") == WorkflowEncryption.MAGIC_HEADER_V2:
+            return WorkflowEncryption.envelope_to_container(encrypted_workflow)
+        envelope = {k: v for k, v in encrypted_workflow.items() if k.startswith("_")}
+        return json.dumps(envelope, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+    
+    @staticmethod
+    def describe(data):
+        """存储对象的元数据"""
+        if data.startswith(STREAM_MAGIC):
+            header, _ = read_stream_header(data)
+            keys = header.get("keys") or [{}]
+            meta = {
+                "format": "container",
+                "version": header.get("v"),
+                "cipher": header.get("cipher"),
+                "salt": keys[0].get("salt") or header.get("salt"),
+            }
+        else:
+            envelope = json_loads(data)
+            meta = {
+                "format": "json",
+                "version": envelope.get("_version", 1),
+                "cipher": envelope.get("_cipher", "XOR"),
+                "salt": envelope.get("_salt"),
+            }
+        meta["size"] = len(data)
+        meta["created"] = time.time()
+        return meta
+    
+    def _signature(self):
+        """索引文件的 (inode, 大小, 修改时间)，不存在时为None；原子替换总会改变inode"""
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+    
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """跨进程写锁（需持有 self._lock，可重入）；不支持 fcntl 的平台上只使用进程内锁"""
+        if self._file_locked or fcntl is None:
+            yield
+            return
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self._file_locked = True
+            try:
+                yield
+            finally:
+                self._file_locked = False
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    
+    def _load_index(self):
+        """读取索引，文件被其他进程替换后重新读取（需持有锁）"""
+        signature = self._signature()
+        if self._index is not None and signature == self._index_signature:
+            return self._index
+        if signature is not None and self._read_index(signature):
+            return self._index
+        
+        with self._file_lock():
+            # 等锁期间其他进程可能已写好索引
+            signature = self._signature()
+            if signature is not None and self._read_index(signature):
+                return self._index
+            if signature is not None:
+                print(f"\033[93m[Workflow Protector] 存储索引损坏，正在重建\033[0m")
+            self._index = {}
+            self._index_signature = None
+            if os.path.isdir(self.root):
+                self._rebuild_index()
+        return self._index
+    
+    def _read_index(self, signature):
+        """读取索引文件，成功返回True（需持有锁）"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except:
+            return False
+        if not isinstance(index, dict):
+            return False
+        self._index = index
+        self._index_signature = signature
+        return True
+    
+    def _rebuild_index(self):
+        """扫描对象文件重建索引（需持有锁）"""
+        for root, dirs, names in os.walk(self.root):
+            for name in names:
+                if not _STORE_ID_RE.match(name):
+                    continue
+                try:
+                    with open(os.path.join(root, name), 'rb') as f:
+                        data = f.read()
+                    if hashlib.sha256(data).hexdigest() != name:
+                        continue
+                    meta = self.describe(data)
+                    meta["created"] = os.path.getmtime(os.path.join(root, name))
+                    self._index[name] = meta
+                except:
+                    pass
+        self._save_index()
+    
+    def _save_index(self):
+        """原子写入索引（需持有锁和文件锁）"""
+        self._write_file(self.index_path, json.dumps(self._index, ensure_ascii=False).encode('utf-8'))
+        self._index_signature = self._signature()
+    
+    def _write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+    
+    def put(self, data):
+        """保存存储用字节，返回 (ID, 元数据, 是否新建)；相同内容直接返回已有对象"""
+        object_id = hashlib.sha256(data).hexdigest()
+        with self._lock, self._file_lock():
+            index = self._load_index()
+            if object_id in index and os.path.exists(self._object_path(object_id)):
+                return object_id, index[object_id], False
+            
+            if sum(m["size"] for m in index.values()) + len(data) > self.max_bytes:
+                raise ValueError("存储空间已满")
+            
+            meta = self.describe(data)
+            self._write_file(self._object_path(object_id), data)
+            index[object_id] = meta
+            self._save_index()
+            return object_id, meta, True
+    
+    def get(self, object_id):
+        """读取对象，返回 (data, 元数据)，不存在时返回 (None, None)"""
+        meta = self.meta(object_id)
+        if meta is None:
+            return None, None
+        try:
+            with open(self._object_path(object_id), 'rb') as f:
+                return f.read(), meta
+        except FileNotFoundError:
+            return None, None
+    
+    def meta(self, object_id):
+        if not _STORE_ID_RE.match(object_id or ""):
+            return None
+        with self._lock:
+            return self._load_index().get(object_id)
+    
+    def delete(self, object_id):
+        """删除对象，返回是否存在"""
+        with self._lock, self._file_lock():
+            index = self._load_index()
+            if index.pop(object_id, None) is None:
+                return False
+            path = self._object_path(object_id)
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+            self._save_index()
+            return True
+    
+    def list(self):
+        """全部对象的元数据，新的在前"""
+        with self._lock:
+            items = [{"id": object_id, **meta} for object_id, meta in self._load_index().items()]
+        items.sort(key=lambda item: item["created"], reverse=True)
+        return items
+    
+    def stats(self):
+        with self._lock:
+            index = self._load_index()
+            return {
+                "objects": len(index),
+                "bytes": sum(m["size"] for m in index.values()),
+                "max_bytes": self.max_bytes
+            }
+
+class DecryptedWorkflowCache:
+    """按会话划分的解密结果缓存（LRU）
+    
+    每个已授权会话最多保存 max_entries 个、共 max_bytes 字节的明文JSON，最多跟踪 max_sessions 个会话。
+    条目记录解密所用密码的 HMAC，命中时密码仍须一致，但不再需要密钥派生和解密。
+    """
+    
+    def __init__(self, max_entries=STORE_CACHE_ENTRIES, max_bytes=STORE_CACHE_BYTES,
+                 max_sessions=STORE_CACHE_SESSIONS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.hits = 0
+        self.misses = 0
+        self._sessions = OrderedDict()  # {session: OrderedDict{object_id: (password_mac, plaintext)}}
+        self._lock = threading.Lock()
+        self._secret = secrets.token_bytes(32)
+    
+    def _password_mac(self, object_id, password):
+        message = object_id.encode('utf-8') + b"\0" + password.encode('utf-8')
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+    
+    def get(self, session, object_id, password):
+        """查找缓存的明文，未命中或密码不一致时返回None"""
+        mac = self._password_mac(object_id, password)
+        with self._lock:
+            entries = self._sessions.get(session)
+            entry = entries.get(object_id) if entries is not None else None
+            if entry is None or not hmac.compare_digest(entry[0], mac):
+                self.misses += 1
+                return None
+            entries.move_to_end(object_id)
+            self._sessions.move_to_end(session)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, session, object_id, password, plaintext):
+        if self.max_entries <= 0 or len(plaintext) > self.max_bytes:
+            return
+        mac = self._password_mac(object_id, password)
+        with self._lock:
+            entries = self._sessions.get(session)
+            if entries is None:
+                entries = self._sessions[session] = OrderedDict()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            entries[object_id] = (mac, plaintext)
+            entries.move_to_end(object_id)
+            self._sessions.move_to_end(session)
+            
+            total = sum(len(e[1]) for e in entries.values())
+            while len(entries) > self.max_entries or total > self.max_bytes:
+                _, (_, evicted) = entries.popitem(last=False)
+                total -= len(evicted)
+    
+    def discard(self, object_id):
+        """对象被删除时从所有会话中移除"""
+        with self._lock:
+            for entries in self._sessions.values():
+                entries.pop(object_id, None)
+    
+    def drop_session(self, session):
+        with self._lock:
+            self._sessions.pop(session, None)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "entries": sum(len(e) for e in self._sessions.values()),
+                "bytes": sum(len(v[1]) for e in self._sessions.values() for v in e.values()),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+_workflow_store = WorkflowStore()
+_decrypted_cache = DecryptedWorkflowCache()
+
+async def _store_session(request):
+    """解密结果缓存的会话键：已授权请求的会话token；未启用保护时按IP区分"""
+    if not await check_authorization(request):
+        return None
+    return get_session_token(request) or f"ip:{get_client_ip(request)}"
+
+def decrypt_stored(data, password):
+    """解密存储对象，返回 (明文JSON字节, 错误信息)"""
+    if data.startswith(STREAM_MAGIC):
+        try:
+            plaintext = b"".join(WorkflowEncryption.iter_decrypt_stream([data], password))
+            json_loads(plaintext)
+        except DecryptionError as e:
+            return None, str(e)
+        except ValueError:
+            return None, "解密失败: 数据不是有效的工作流"
+        return plaintext, None
+    
+    workflow, error = WorkflowEncryption.decrypt_workflow(json_loads(data), password)
+    if error:
+        return None, error
+    return json_dumps(workflow), None
+
+def _decrypted_response(object_id, plaintext):
+    """拼接解密响应，明文JSON直接嵌入，不再重新解析和序列化"""
+    prefix = json.dumps({"success": True, "message": "解密成功", "id": object_id}, ensure_ascii=False)
+    body = prefix[:-1].encode('utf-8') + b', "workflow": ' + plaintext + b"}"
+    return web.Response(body=body, content_type="application/json")
+
+@PromptServer.instance.routes.post("/workflow_protector/store")
+@instrumented("store_put")
+async def store_workflow(request):
+    """保存加密工作流，返回内容哈希ID
+    
+    请求体为二进制容器（application/octet-stream），或 JSON：
+    workflow 为加密工作流时原样保存；为明文时需同时提供 password，先加密再保存。
+    """
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    try:
+        if request.content_type == "application/octet-stream":
+            encrypted = await request.read()
+        else:
+            data = await read_json(request)
+            encrypted = data.get("workflow")
+            password = data.get("password", "")
+            if not encrypted:
+                return json_response({"success": False, "message": "工作流数据为空"})
+            
+            if not WorkflowEncryption.is_encrypted(encrypted):
+                if len(password) < 4:
+                    return json_response({"success": False, "message": "密码至少4位"})
+                # V2 直接加密为二进制容器，省去JSON封装再转换
+                if DEFAULT_ENCRYPTION_VERSION == 2:
+                    encrypt = WorkflowEncryption.encrypt_to_container
+                else:
+                    encrypt = WorkflowEncryption.encrypt_workflow
+                encrypted = await run_in_kdf_pool(
+                    encrypt, encrypted, password,
+                    compression=data.get("compression"),
+                    compression_level=data.get("compression_level")
+                )
+        
+        loop = asyncio.get_running_loop()
+        object_id, meta, created = await loop.run_in_executor(
+            None, lambda: _workflow_store.put(WorkflowStore.canonicalize(encrypted))
+        )
+        
+        return json_response({
+            "success": True,
+            "message": "已保存" if created else "已存在相同内容",
+            "id": object_id,
+            "created": created,
+            "meta": meta
+        })
+        
+    except DecryptionError as e:
+        return json_response({"success": False, "message": str(e)})
+    except Exception as e:
+        return json_response({"success": False, "message": str(e)})
+
+@PromptServer.instance.routes.get("/workflow_protector/store")
+async def list_stored_workflows(request):
+    """列出存储中的加密工作流（元数据）"""
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    loop = asyncio.get_running_loop()
+    return json_response({
+        "success": True,
+        "workflows": await loop.run_in_executor(None, _workflow_store.list),
+        "stats": await loop.run_in_executor(None, _workflow_store.stats),
+        "cache": _decrypted_cache.stats()
+    })
+
+@PromptServer.instance.routes.get("/workflow_protector/store/{id}")
+async def get_stored_workflow(request):
+    """按ID获取加密工作流（JSON封装，或 format=binary / Accept 为二进制时返回容器）
+    
+    对象内容不可变，ID即ETag，客户端可长期缓存。
+    与列表、删除一样需要授权：拿到密文即可离线猜测密码，不受失败限流约束。
+    """
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    object_id = request.match_info["id"]
+    etag = f'"{object_id}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, _workflow_store.meta, object_id) is None:
+        return json_response({"success": False, "message": "工作流不存在"}, status=404)
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers=headers)
+    
+    data, meta = await loop.run_in_executor(None, _workflow_store.get, object_id)
+    if data is None:
+        return json_response({"success": False, "message": "工作流不存在"}, status=404)
+    
+    if meta["format"] == "container":
+        if _wants_binary(request, request.query):
+            return web.Response(body=data, content_type="application/octet-stream", headers=headers)
+        return json_response(WorkflowEncryption.container_to_envelope(data), headers=headers)
+    
+    envelope = json_loads(data)
+    envelope.update(WorkflowEncryption._decoy_workflow())
+    return json_response(envelope, headers=headers)
+
+@PromptServer.instance.routes.delete("/workflow_protector/store/{id}")
+async def delete_stored_workflow(request):
+    """删除存储中的加密工作流"""
+    if not await check_authorization(request):
+        return json_response({"success": False, "message": "需要授权"}, status=401)
+    
+    object_id = request.match_info["id"]
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, _workflow_store.delete, object_id):
+        return json_response({"success": False, "message": "工作流不存在"}, status=404)
+    
+    _decrypted_cache.discard(object_id)
+    log_attempt("store_delete", True, get_client_ip(request), object_id)
+    return json_response({"success": True, "message": "已删除"})
+
+@PromptServer.instance.routes.post("/workflow_protector/store/{id}/decrypt")
+@instrumented("store_decrypt")
+async def decrypt_stored_workflow(request):
+    """按ID解密存储中的工作流
+    
+    已授权会话会缓存最近的解密结果，同一会话用同一密码再次打开时直接返回明文。
+    """
+    object_id = request.match_info["id"]
+    
+    try:
+        data = await read_json(request)
+        password = data.get("password", "")
+        
+        if not password:
+            return json_response({"success": False, "message": "解密密码不能为空"})
+        
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, _workflow_store.meta, object_id) is None:
+            return json_response({"success": False, "message": "工作流不存在"}, status=404)
+        
+        session = await _store_session(request)
+        if session is not None:
+            plaintext = _decrypted_cache.get(session, object_id, password)
+            if plaintext is not None:
+                return _decrypted_response(object_id, plaintext)
+        
+        ip = get_client_ip(request)
+        throttled = throttle_response(ip, "store_decrypt")
+        if throttled:
+            return throttled
+        
+        stored, _ = await loop.run_in_executor(None, _workflow_store.get, object_id)
+        if stored is None:
+            _brute_force_limiter.release(ip)
+            return json_response({"success": False, "message": "工作流不存在"}, status=404)
+        
+        plaintext, error = await run_password_check(ip, decrypt_stored, stored, password)
+        record_decrypt_result(ip, error)
+        
+        if error:
+            log_attempt("store_decrypt", False, ip, error)
+            return json_response({"success": False, "message": error})
+        
+        log_attempt("store_decrypt", True, ip, object_id)
+        if session is not None:
+            _decrypted_cache.put(session, object_id, password, plaintext)
+        return _decrypted_response(object_id, plaintext)
+        
+    except Exception as e:
+        return json_response({"success": False, "message": str(e)})
 
 # ==================== 初始化 ====================
 
@@ -825,5 +4390,5 @@ print("\033[92m║  Workflow Protector 安全增强版 已加载      ║\033[0m
 print("\033[92m║  • PBKDF2-SHA256 密码哈希 (10万次迭代)    ║\033[0m")
 print("\033[92m║  • 随机盐值 + 安装唯一密钥                ║\033[0m")
 print("\033[92m║  • 配置文件权限保护 (600)                 ║\033[0m")
-print("\033[92m║  • 会话时长: 5分钟 | 错误延迟: 2秒        ║\033[0m")
+print("\033[92m║  • 会话时长: 5分钟 | 失败尝试限流         ║\033[0m")
 print("\033[92m╚════════════════════════════════════════════╝\033[0m")
@@ -17,11 +17,11 @@ let isDecryptingWorkflow = false; // 是否正在处理加密工作流解密
 
 // ==================== 加密检测与操作 ====================
 
-const MAGIC_HEADER = "COMFYUI_PROTECTED_WORKFLOW_V1";
+const MAGIC_HEADERS = ["COMFYUI_PROTECTED_WORKFLOW_V1", "COMFYUI_PROTECTED_WORKFLOW_V2"];
 
 // 检查是否是加密的工作流
 function isEncryptedWorkflow(data) {
-    return data && data._protected === MAGIC_HEADER;
+    return data && MAGIC_HEADERS.includes(data._protected);
 }
 
 // 调用后端加密API
@@ -508,16 +508,51 @@ document.head.appendChild(styleEl);
 
 // ==================== 工具函数 ====================
 
-async function fetchStatus() {
-    try {
-        const response = await fetch('/api/workflow_protector/status');
-        const newStatus = await response.json();
-        protectionStatus = newStatus;
-        return protectionStatus;
-    } catch (e) {
-        console.error('[Workflow Protector] 获取状态失败:', e);
+// 状态缓存：短时间内的重复调用直接返回缓存，并发调用共用同一个请求
+const STATUS_MAX_AGE = 2000;
+let statusETag = null;
+let statusFetchedAt = 0;
+let statusRequest = null;
+
+async function requestStatus(wait = 0) {
+    const headers = statusETag ? { 'If-None-Match': statusETag } : {};
+    const url = wait ? `/api/workflow_protector/status?wait=${wait}` : '/api/workflow_protector/status';
+    const response = await fetch(url, { headers, cache: 'no-store' });
+    statusFetchedAt = Date.now();
+    if (response.status === 304) return protectionStatus;
+    
+    protectionStatus = await response.json();
+    statusETag = response.headers.get('ETag');
+    return protectionStatus;
+}
+
+// force: 修改设置后需要立即拿到最新状态时使用
+async function fetchStatus(force = false) {
+    if (!force && Date.now() - statusFetchedAt < STATUS_MAX_AGE) {
         return protectionStatus;
     }
+    if (statusRequest) {
+        return statusRequest;
+    }
+    
+    statusRequest = requestStatus()
+        .catch(e => {
+            console.error('[Workflow Protector] 获取状态失败:', e);
+            return protectionStatus;
+        })
+        .finally(() => { statusRequest = null; });
+    return statusRequest;
+}
+
+// 长轮询：状态未变化时服务端挂起请求，配置变更后立即返回
+async function watchStatus() {
+    while (true) {
+        try {
+            await requestStatus(25);
+        } catch (e) {
+            await new Promise(r => setTimeout(r, 30000));
+        }
+    }
 }
 
 function isAuthorized() {
@@ -741,7 +776,7 @@ function showPasswordDialog(action) {
 // ==================== 设置对话框 ====================
 
 async function showSettingsDialog() {
-    const status = await fetchStatus();
+    const status = await fetchStatus(true);
     
     const overlay = document.createElement('div');
     overlay.className = 'wp-overlay';
@@ -838,6 +873,7 @@ async function showSettingsDialog() {
         <div class="wp-tab-content" id="tab-logs">
             <div class="wp-section">
                 <div class="wp-label">最近访问记录</div>
+                <div id="wp-log-stats" style="color:#888;font-size:12px;margin-bottom:8px"></div>
                 <div class="wp-log-container" id="wp-logs">加载中...</div>
                 <button class="wp-btn wp-btn-secondary" id="wp-refresh-logs" style="width:100%;margin-top:10px">刷新日志</button>
                 <button class="wp-btn wp-btn-danger" id="wp-clear-logs" style="width:100%;margin-top:8px">清除日志</button>
@@ -868,10 +904,21 @@ async function showSettingsDialog() {
         const container = document.getElementById('wp-logs');
         if (!container) return;
         try {
-            const resp = await fetch('/api/workflow_protector/logs', {
-                headers: { 'X-WP-Token': currentToken }
-            });
+            const headers = { 'X-WP-Token': currentToken };
+            const [resp, statsResp] = await Promise.all([
+                fetch('/api/workflow_protector/logs', { headers }),
+                fetch('/api/workflow_protector/logs/stats?minutes=60', { headers })
+            ]);
             const result = await resp.json();
+            const stats = await statsResp.json();
+            
+            const statsEl = document.getElementById('wp-log-stats');
+            if (statsEl && stats.success) {
+                const lastHour = stats.per_minute.reduce((sum, m) => sum + m.failures, 0);
+                const topIp = stats.failures_by_ip[0];
+                statsEl.textContent = `共 ${stats.total} 次 | 失败 ${stats.failures} 次 | 近1小时失败 ${lastHour} 次` +
+                    (topIp ? ` | 失败最多: ${topIp.ip} (${topIp.failures})` : '');
+            }
             
             if (result.success && result.logs.length > 0) {
                 container.innerHTML = result.logs.reverse().map(log => 
@@ -924,7 +971,7 @@ async function showSettingsDialog() {
                 await new Promise(r => setTimeout(r, 300));
                 
                 // 更新全局状态
-                protectionStatus = await fetchStatus();
+                protectionStatus = await fetchStatus(true);
                 
                 setTimeout(() => { 
                     cleanup(); 
@@ -956,7 +1003,7 @@ async function showSettingsDialog() {
                     showMsg(result.message, false);
                     clearToken();
                     // 立即更新全局状态
-                    protectionStatus = await fetchStatus();
+                    protectionStatus = await fetchStatus(true);
                     console.log('[Workflow Protector] 密码已清除，当前状态:', protectionStatus);
                     setTimeout(() => { cleanup(); showSettingsDialog(); }, 800);
                 } else {
@@ -1857,9 +1904,5 @@ fetchStatus().then(status => {
     console.log('[Workflow Protector] 加密说明: 保存时可选加密，本机自动解密，其他电脑需要密码');
 });
 
-// 定期刷新状态（每30秒）
-setInterval(() => {
-    fetchStatus().then(status => {
-        // 静默更新，不输出日志
-    });
-}, 30000);
+// 持续监听状态变化（长轮询，替代定时刷新）
+watchStatus();
@@ -0,0 +1,72 @@
+"""
+离线加载 Workflow Protector 插件（无需启动 ComfyUI）
+
+命令行工具和基准测试通过 load_plugin() 获取插件模块：
+- 注入一个最小的 server.PromptServer 替身，使路由注册可以正常执行
+- 将 __init__.py 复制到临时目录后加载，配置/密钥/日志文件都写在该目录，
+  不会改动真实安装目录下的 .wp_config / .wp_key
+"""
+
+import atexit
+import contextlib
+import importlib.util
+import io
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+MODULE_NAME = "workflow_protector_offline"
+
+
+def _install_stub_server():
+    """注入 server.PromptServer 替身"""
+    from aiohttp import web
+
+    class PromptServer:
+        instance = None
+
+        def __init__(self):
+            self.routes = web.RouteTableDef()
+            self.app = web.Application()
+            self.loop = None
+
+        def send_sync(self, event, data, sid=None):
+            pass
+
+    PromptServer.instance = PromptServer()
+
+    module = types.ModuleType("server")
+    module.PromptServer = PromptServer
+    sys.modules["server"] = module
+
+
+def load_plugin(workdir=None, quiet=True):
+    """加载插件模块，返回模块对象
+
+    workdir 为空时使用临时目录，进程退出时自动删除。
+    """
+    if MODULE_NAME in sys.modules:
+        return sys.modules[MODULE_NAME]
+
+    _install_stub_server()
+
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="wp_offline_")
+        atexit.register(shutil.rmtree, workdir, True)
+
+    plugin_file = os.path.join(workdir, "__init__.py")
+    shutil.copy2(os.path.join(PLUGIN_DIR, "__init__.py"), plugin_file)
+
+    spec = importlib.util.spec_from_file_location(MODULE_NAME, plugin_file)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[MODULE_NAME] = module
+
+    # 插件加载时会打印启动横幅，离线工具默认不输出
+    output = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        spec.loader.exec_module(module)
+
+    return module
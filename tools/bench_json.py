@@ -0,0 +1,123 @@
+"""
+JSON 编解码器基准测试
+
+在大工作流上对比标准库 json 与 orjson / msgspec（已安装时）：
+- 单独的解析 / 序列化
+- 加密、解密接口的完整路径（解析请求体 → 加解密 → 序列化响应，密钥派生已预先完成）
+
+计时前先对 json / orjson / msgspec 各做一次往返检查（未安装的跳过）：含 NaN / Infinity 的
+请求体和直接传入的 float('nan') 等经加密、解密后仍须是 NaN / Infinity，而不是 null。
+
+用法:
+    python tools/bench_json.py
+    python tools/bench_json.py --sizes 1048576 33554432 --repeat 5
+"""
+
+import argparse
+import math
+import time
+
+from _offline import load_plugin
+from benchmark import make_workflow
+
+PASSWORD = "benchmark-password"
+
+
+def best_of(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_round_trip(plugin, codec):
+    """NaN / Infinity 经 加密请求 → 解密响应 后保持不变"""
+    plugin.JSON_CODEC = codec
+    body = b'{"workflow": {"widgets_values": [NaN, Infinity, -Infinity, 1e400, 1.5, null]}, "password": "%s"}' % PASSWORD.encode()
+    sources = {
+        "request body": plugin.json_loads(body)["workflow"],
+        "python floats": {"widgets_values": [math.nan, math.inf, -math.inf, math.inf, 1.5, None]},
+    }
+    for source, workflow in sources.items():
+        for encrypt in (plugin.WorkflowEncryption.encrypt_workflow, plugin.WorkflowEncryption.encrypt_to_container):
+            encrypted = encrypt(workflow, PASSWORD)
+            if isinstance(encrypted, bytes):
+                encrypted = plugin.WorkflowEncryption.container_to_envelope(encrypted)
+            encrypted = plugin.json_loads(plugin.json_dumps({"success": True, "encrypted": encrypted}))["encrypted"]
+            decrypted, error = plugin.WorkflowEncryption.decrypt_workflow(encrypted, PASSWORD)
+            assert error is None, error
+            values = plugin.json_loads(plugin.json_dumps({"workflow": decrypted}))["workflow"]["widgets_values"]
+            assert (math.isnan(values[0]) and values[1] == values[3] == math.inf and values[2] == -math.inf
+                    and values[4] == 1.5 and values[5] is None), \
+                f"{codec} ({source}, {encrypt.__name__}): non-finite values lost in round trip: {values}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON codec benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1 << 20, 1 << 23, 1 << 25])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    encryption = plugin.WorkflowEncryption
+    codecs = plugin.available_json_codecs()
+    selected = plugin.JSON_CODEC
+
+    keyring = plugin.KeyRing(PASSWORD, shared_salt=True)
+    keyring.key_for(keyring.salt)
+
+    try:
+        for codec in ("json", "orjson", "msgspec"):
+            if codec in codecs:
+                check_round_trip(plugin, codec)
+                print(f"round trip ok: {codec}")
+            else:
+                print(f"round trip skipped: {codec} not installed")
+        print()
+
+        header = (f"{'size':>10}  {'codec':>8}  {'loads (s)':>10}  {'dumps (s)':>10}  "
+                  f"{'encrypt (s)':>11}  {'decrypt (s)':>11}  {'speedup':>8}")
+        print(header)
+        print("-" * len(header))
+
+        for size in args.sizes:
+            workflow = make_workflow(size)
+            plugin.JSON_CODEC = "json"
+            request_body = plugin.json_dumps({"workflow": workflow, "password": PASSWORD})
+            encrypted = encryption.encrypt_workflow(workflow, PASSWORD, keyring=keyring)
+            decrypt_body = plugin.json_dumps({"workflow": encrypted, "password": PASSWORD})
+
+            def encrypt_request():
+                data = plugin.json_loads(request_body)
+                result = encryption.encrypt_workflow(data["workflow"], PASSWORD, keyring=keyring)
+                plugin.json_dumps({"success": True, "message": "加密成功", "encrypted": result})
+
+            def decrypt_request():
+                data = plugin.json_loads(decrypt_body)
+                result, error = encryption.decrypt_workflow(data["workflow"], PASSWORD, keyring=keyring)
+                assert error is None and result == workflow, error
+                plugin.json_dumps({"success": True, "message": "解密成功", "workflow": result})
+
+            baseline = None
+            for codec in codecs:
+                plugin.JSON_CODEC = codec
+                assert plugin.json_loads(request_body)["workflow"] == workflow
+
+                loads_time = best_of(lambda: plugin.json_loads(request_body), args.repeat)
+                dumps_time = best_of(lambda: plugin.json_dumps(workflow), args.repeat)
+                encrypt_time = best_of(encrypt_request, args.repeat)
+                decrypt_time = best_of(decrypt_request, args.repeat)
+
+                total = encrypt_time + decrypt_time
+                if baseline is None:
+                    baseline = total
+                print(f"{len(request_body):>10}  {codec:>8}  {loads_time:>10.4f}  {dumps_time:>10.4f}  "
+                      f"{encrypt_time:>11.4f}  {decrypt_time:>11.4f}  {baseline / total:>7.2f}x")
+    finally:
+        plugin.JSON_CODEC = selected
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+XOR 后备加密基准测试
+
+对比旧版逐字节实现与当前整块异或实现（int.from_bytes / NumPy），
+并校验输出逐字节一致。
+
+用法:
+    python tools/bench_xor.py
+    python tools/bench_xor.py --sizes 1024 1048576 --repeat 5
+"""
+
+import argparse
+import secrets
+import time
+
+from _offline import load_plugin
+
+
+def xor_reference(data, key, iv):
+    """旧版逐字节实现（对照组）"""
+    result = bytearray()
+    key_iv = key + iv
+    for i, byte in enumerate(data):
+        result.append(byte ^ key_iv[i % len(key_iv)])
+    return bytes(result)
+
+
+def best_of(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XOR fallback cipher benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1 << 10, 1 << 14, 1 << 17, 1 << 20, 1 << 22])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    encryption = plugin.WorkflowEncryption
+    has_numpy = plugin.HAS_NUMPY
+
+    key = secrets.token_bytes(32)
+    iv = secrets.token_bytes(16)
+
+    header = f"{'size':>10}  {'loop (s)':>10}  {'int (s)':>10}  {'numpy (s)':>10}  {'speedup':>8}"
+    print(header)
+    print("-" * len(header))
+
+    for size in args.sizes:
+        data = secrets.token_bytes(size)
+        expected = xor_reference(data, key, iv)
+
+        loop_time = best_of(lambda: xor_reference(data, key, iv), args.repeat)
+
+        plugin.HAS_NUMPY = False
+        assert encryption._xor_encrypt(data, key, iv) == expected
+        int_time = best_of(lambda: encryption._xor_encrypt(data, key, iv), args.repeat)
+
+        numpy_time = None
+        if has_numpy:
+            plugin.HAS_NUMPY = True
+            assert encryption._xor_encrypt(data, key, iv) == expected
+            numpy_time = best_of(lambda: encryption._xor_encrypt(data, key, iv), args.repeat)
+
+        fastest = min(t for t in (int_time, numpy_time) if t is not None)
+        numpy_col = f"{numpy_time:>10.5f}" if numpy_time is not None else f"{'n/a':>10}"
+        print(f"{size:>10}  {loop_time:>10.5f}  {int_time:>10.5f}  {numpy_col}  {loop_time / fastest:>7.0f}x")
+
+    plugin.HAS_NUMPY = has_numpy
+
+
+if __name__ == "__main__":
+    main()
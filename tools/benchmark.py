@@ -0,0 +1,304 @@
+"""
+Workflow Protector 基准测试套件（离线运行，无需启动 ComfyUI）
+
+覆盖热路径：
+- 工作流加密/解密：不同大小 × 不同加密方式（V2 AES-GCM / V1 AES-CBC / V1 XOR 后备）
+- hash_password（PBKDF2）延迟
+- load_config / save_config
+- 会话创建/验证吞吐（已有 N 个有效会话，内存与 SQLite 后端）
+- log_attempt 吞吐与写盘耗时
+
+结果以 JSON 输出，可用 --compare 与上一版本的结果对比。
+
+用法:
+    python tools/benchmark.py
+    python tools/benchmark.py --quick -o bench.json
+    python tools/benchmark.py --only crypto --sizes 1024 1048576
+    python tools/benchmark.py -o new.json --compare old.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+from _offline import load_plugin
+
+SECTIONS = ("crypto", "kdf", "config", "sessions", "logging")
+PASSWORD = "benchmark-password"
+
+
+def measure(func, repeat=5, number=1):
+    """执行 repeat 轮、每轮 number 次，返回单次耗时统计（毫秒）"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    best = min(samples)
+    return {
+        "min_ms": round(best * 1000, 4),
+        "median_ms": round(statistics.median(samples) * 1000, 4),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4),
+        "ops_per_second": round(1 / best, 1) if best > 0 else None,
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def make_workflow(size):
+    """生成大约 size 字节的工作流JSON"""
+    nodes = []
+    workflow = {"last_node_id": 0, "nodes": nodes, "links": [], "version": 0.4}
+    node_size = len(json.dumps(_make_node(0)))
+    for i in range(max(1, size // node_size)):
+        nodes.append(_make_node(i))
+    workflow["last_node_id"] = len(nodes)
+    return workflow
+
+
+def _make_node(i):
+    return {
+        "id": i,
+        "type": "KSampler",
+        "pos": [i * 10.5, i * 3.25],
+        "size": [315, 262],
+        "inputs": [{"name": "model", "type": "MODEL", "link": i}],
+        "outputs": [{"name": "LATENT", "type": "LATENT", "links": [i + 1]}],
+        "widgets_values": [i * 7919 % 100000, "randomize", 20, 8.0, "euler", "normal", 1.0],
+    }
+
+
+def bench_crypto(plugin, sizes, repeat):
+    """加密/解密：使用共享盐的密钥环，只测量加解密本身（密钥派生单独测量）"""
+    ciphers = []
+    if plugin.HAS_CRYPTO:
+        ciphers += [("aes-gcm-v2", 2, True), ("aes-cbc-v1", 1, True)]
+    ciphers.append(("xor-v1", 1, False))
+
+    has_crypto = plugin.HAS_CRYPTO
+    keyring = plugin.KeyRing(PASSWORD, shared_salt=True)
+    keyring.key_for(keyring.salt)
+
+    results = []
+    try:
+        for name, version, use_crypto in ciphers:
+            plugin.HAS_CRYPTO = use_crypto
+            for size in sizes:
+                workflow = make_workflow(size)
+                payload = len(json.dumps(workflow, ensure_ascii=False).encode("utf-8"))
+                number = max(1, min(50, (1 << 20) // max(payload, 1)))
+
+                encrypted = plugin.WorkflowEncryption.encrypt_workflow(
+                    workflow, PASSWORD, version=version, keyring=keyring
+                )
+                decrypted, error = plugin.WorkflowEncryption.decrypt_workflow(
+                    encrypted, PASSWORD, keyring=keyring
+                )
+                assert error is None and decrypted == workflow, error
+
+                encrypt = measure(
+                    lambda: plugin.WorkflowEncryption.encrypt_workflow(
+                        workflow, PASSWORD, version=version, keyring=keyring
+                    ),
+                    repeat, number,
+                )
+                decrypt = measure(
+                    lambda: plugin.WorkflowEncryption.decrypt_workflow(encrypted, PASSWORD, keyring=keyring),
+                    repeat, number,
+                )
+                for operation, stats in (("encrypt", encrypt), ("decrypt", decrypt)):
+                    stats["mb_per_second"] = round(payload / (stats["min_ms"] / 1000) / (1 << 20), 2)
+                    results.append({
+                        "name": f"{operation}/{name}/{payload}",
+                        "cipher": name,
+                        "operation": operation,
+                        "bytes": payload,
+                        "encrypted_bytes": len(json.dumps(encrypted)),
+                        **stats,
+                    })
+    finally:
+        plugin.HAS_CRYPTO = has_crypto
+    return results
+
+
+def bench_kdf(plugin, repeat):
+    """hash_password / derive_key 延迟（PBKDF2-SHA256 10万次迭代）"""
+    return [
+        {"name": "hash_password", **measure(lambda: plugin.hash_password(PASSWORD), repeat)},
+        {"name": "derive_key", **measure(lambda: plugin.WorkflowEncryption.derive_key(PASSWORD, "00" * 16), repeat)},
+    ]
+
+
+def bench_config(plugin, repeat):
+    config = plugin.load_config()
+    plugin.save_config(config)
+
+    def load_cold():
+        plugin._config_cache["signature"] = None
+        plugin.load_config()
+
+    return [
+        {"name": "load_config/cached", **measure(plugin.load_config, repeat, 2000)},
+        {"name": "load_config/cold", **measure(load_cold, repeat, 200)},
+        {"name": "save_config", **measure(lambda: plugin.save_config(config), repeat, 50)},
+    ]
+
+
+def bench_sessions(plugin, live, repeat):
+    """已有 live 个有效会话时的创建/验证吞吐"""
+    results = []
+    original = plugin.active_sessions
+    try:
+        for backend in ("memory", "sqlite"):
+            store = plugin.create_session_backend(backend)
+            store.clear()
+            plugin.active_sessions = store
+            tokens = [plugin.create_session(f"10.0.{i // 256 % 256}.{i % 256}") for i in range(live)]
+            probe = tokens[len(tokens) // 2]
+
+            results.append({
+                "name": f"create_session/{backend}",
+                "live_sessions": live,
+                **measure(lambda: plugin.create_session("127.0.0.1"), repeat, 200),
+            })
+            results.append({
+                "name": f"verify_session/{backend}",
+                "live_sessions": live,
+                **measure(lambda: plugin.verify_session(probe, "10.0.0.0"), repeat, 2000),
+            })
+            results.append({
+                "name": f"verify_session/{backend}/miss",
+                "live_sessions": live,
+                **measure(lambda: plugin.verify_session("no-such-token", "10.0.0.0"), repeat, 2000),
+            })
+            store.clear()
+    finally:
+        plugin.active_sessions = original
+    return results
+
+
+def bench_logging(plugin, lines, repeat):
+    """log_attempt（仅入队）吞吐，以及把积压写入磁盘的耗时"""
+    writer = plugin._log_writer
+
+    def enqueue():
+        for i in range(lines):
+            plugin.log_attempt("verify", i % 3 != 0, f"10.0.0.{i % 256}", "benchmark")
+
+    enqueue_stats = measure(enqueue, repeat)
+    writer.flush()
+
+    flush_samples = []
+    for _ in range(repeat):
+        enqueue()
+        start = time.perf_counter()
+        writer.flush()
+        flush_samples.append(time.perf_counter() - start)
+    writer.remove()
+
+    enqueue_stats["lines_per_second"] = round(lines / (enqueue_stats["min_ms"] / 1000), 1)
+    return [
+        {"name": "log_attempt", "lines": lines, **enqueue_stats},
+        {
+            "name": "log_flush",
+            "lines": lines,
+            "min_ms": round(min(flush_samples) * 1000, 4),
+            "median_ms": round(statistics.median(flush_samples) * 1000, 4),
+            "repeat": repeat,
+        },
+    ]
+
+
+def compare(results, baseline):
+    """对比两次结果的最小耗时，打印变化百分比"""
+    previous = {r["name"]: r for r in baseline.get("results", [])}
+    print(f"{'benchmark':<40}  {'old (ms)':>10}  {'new (ms)':>10}  {'change':>8}")
+    for result in results["results"]:
+        old = previous.get(result["name"])
+        if old is None or not old.get("min_ms"):
+            continue
+        change = (result["min_ms"] - old["min_ms"]) / old["min_ms"] * 100
+        print(f"{result['name']:<40}  {old['min_ms']:>10.4f}  {result['min_ms']:>10.4f}  {change:>+7.1f}%")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Workflow Protector benchmark suite")
+    parser.add_argument("--only", nargs="+", choices=SECTIONS, help="只运行指定部分 / run selected sections only")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1 << 10, 1 << 16, 1 << 20],
+                        help="工作流大小（字节）/ workflow sizes in bytes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sessions", type=int, default=10000, help="预先创建的有效会话数 / live sessions")
+    parser.add_argument("--log-lines", type=int, default=5000)
+    parser.add_argument("--quick", action="store_true", help="缩小规模快速运行 / smaller, faster run")
+    parser.add_argument("-o", "--output", help="结果JSON文件（默认输出到标准输出）/ write JSON here")
+    parser.add_argument("--compare", help="与之前的结果JSON对比 / compare with a previous result file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.quick:
+        args.sizes = [1 << 10, 1 << 16]
+        args.repeat = 3
+        args.sessions = 1000
+        args.log_lines = 1000
+
+    plugin = load_plugin()
+    sections = args.only or SECTIONS
+
+    results = []
+    timings = {}
+    for section in sections:
+        start = time.perf_counter()
+        if section == "crypto":
+            results += bench_crypto(plugin, args.sizes, args.repeat)
+        elif section == "kdf":
+            results += bench_kdf(plugin, args.repeat)
+        elif section == "config":
+            results += bench_config(plugin, args.repeat)
+        elif section == "sessions":
+            results += bench_sessions(plugin, args.sessions, args.repeat)
+        elif section == "logging":
+            results += bench_logging(plugin, args.log_lines, args.repeat)
+        timings[section] = round(time.perf_counter() - start, 2)
+        print(f"[{section}] done in {timings[section]}s", file=sys.stderr)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "has_crypto": plugin.HAS_CRYPTO,
+            "has_numpy": plugin.HAS_NUMPY,
+            "compressions": plugin.available_compressions(),
+        },
+        "options": {
+            "sizes": args.sizes,
+            "repeat": args.repeat,
+            "sessions": args.sessions,
+            "log_lines": args.log_lines,
+        },
+        "section_seconds": timings,
+        "results": results,
+    }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
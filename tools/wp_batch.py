@@ -0,0 +1,155 @@
+"""
+批量加密/解密/更换密码（命令行，无需启动 ComfyUI）
+
+与插件共用 WorkflowEncryption，文件按进程池并行处理，充分利用多核。
+使用 --shared-salt 时整批文件共用一个盐，只需派生一次密钥。
+rekey 只重新包装各文件头部中的数据密钥，新密码整批只派生一次，默认原地改写。
+
+用法:
+    python tools/wp_batch.py encrypt ./workflows --shared-salt
+    python tools/wp_batch.py encrypt a.json b.json -o ./out --format binary
+    python tools/wp_batch.py decrypt ./workflows -o ./plain --workers 8
+    python tools/wp_batch.py rekey ./workflows -r --keep-old
+"""
+
+import argparse
+import getpass
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from _offline import load_plugin
+
+plugin = load_plugin()
+
+_worker_state = {}
+
+
+def _init_worker(password, mode, salt, keys, options, new_salt=None, new_keys=None):
+    """子进程初始化：用父进程已派生的密钥构建密钥环"""
+    _worker_state["password"] = password
+    _worker_state["mode"] = mode
+    _worker_state["options"] = options
+    _worker_state["keyring"] = plugin.KeyRing(password, salt=salt, keys=keys)
+    if new_salt:
+        options["new_keyring"] = plugin.KeyRing(options["new_password"], salt=new_salt, keys=new_keys)
+
+
+def _process(item):
+    return plugin.process_batch_item(
+        item,
+        _worker_state["password"],
+        _worker_state["mode"],
+        _worker_state["keyring"],
+        **_worker_state["options"]
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch encrypt/decrypt/rekey ComfyUI workflows")
+    parser.add_argument("mode", choices=["encrypt", "decrypt", "rekey"])
+    parser.add_argument("paths", nargs="+", help="工作流文件或目录 / workflow files or directories")
+    parser.add_argument("-p", "--password", help="密码（省略时交互输入）/ password (prompted if omitted)")
+    parser.add_argument("--new-password", help="rekey 的新密码（省略时交互输入）/ new password for rekey")
+    parser.add_argument("--keep-old", action="store_true",
+                        help="rekey 时保留原密码，即添加一个密码 / add the new password instead of replacing")
+    parser.add_argument("-o", "--output-dir", help="输出目录（默认与源文件相同）/ output directory")
+    parser.add_argument("-r", "--recursive", action="store_true", help="递归处理子目录 / recurse into subdirectories")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--shared-salt", action="store_true",
+                        help="整批共用一个盐，只派生一次密钥 / derive the key once for the whole batch")
+    parser.add_argument("--format", choices=["json", "binary"], default="json")
+    parser.add_argument("--version", type=int, choices=[1, 2])
+    parser.add_argument("--compression", choices=["none", "zlib", "zstd", "brotli"])
+    parser.add_argument("--level", type=int, help="压缩级别 / compression level")
+    parser.add_argument("--overwrite", action="store_true", help="覆盖已存在的输出文件 / overwrite outputs")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果 / print results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    password = args.password or getpass.getpass("Password: ")
+    if len(password) < 4:
+        print("密码至少4位 / password must be at least 4 characters", file=sys.stderr)
+        return 2
+
+    new_password = None
+    if args.mode == "rekey":
+        new_password = args.new_password or getpass.getpass("New password: ")
+        if len(new_password) < 4:
+            print("新密码至少4位 / new password must be at least 4 characters", file=sys.stderr)
+            return 2
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    binary = args.format == "binary"
+    files = plugin.collect_batch_files(args.paths, args.mode, recursive=args.recursive)
+    items = [
+        {"name": f, "src": f, "dst": plugin.batch_output_path(f, args.mode, args.output_dir, binary)}
+        for f in files
+    ]
+    if not items:
+        print("没有找到工作流文件 / no workflow files found", file=sys.stderr)
+        return 1
+
+    options = {
+        "version": args.version,
+        "compression": args.compression,
+        "compression_level": args.level,
+        "binary": binary,
+        "overwrite": args.overwrite,
+    }
+    if args.mode == "rekey":
+        options["new_password"] = new_password
+        options["keep_old"] = args.keep_old
+
+    start = time.perf_counter()
+
+    # 共用盐时在父进程派生一次，再分发给所有子进程
+    keyring = plugin.KeyRing(password, shared_salt=args.shared_salt and args.mode == "encrypt")
+    if keyring.salt:
+        keyring.key_for(keyring.salt)
+    new_keyring = plugin.KeyRing(new_password, shared_salt=True) if new_password else None
+    if new_keyring:
+        new_keyring.key_for(new_keyring.salt)
+
+    workers = max(1, min(args.workers, len(items)))
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(
+            password, args.mode, keyring.salt, keyring.keys, options,
+            new_keyring and new_keyring.salt, new_keyring and new_keyring.keys,
+        ),
+    ) as executor:
+        futures = [executor.submit(_process, item) for item in items]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if not args.json:
+                mark = "✓" if result["success"] else ("-" if result.get("skipped") else "✗")
+                detail = result.get("output_path") if result["success"] else result.get("message")
+                print(f"[{mark}] {result['name']} ({result['seconds']:.3f}s) {detail}")
+
+    summary = plugin.summarize_batch(results, time.perf_counter() - start)
+    summary["workers"] = workers
+
+    if args.json:
+        print(json.dumps({"results": results, "summary": summary}, ensure_ascii=False, indent=2))
+    else:
+        print(
+            f"{summary['succeeded']}/{summary['files']} succeeded, {summary['skipped']} skipped in {summary['seconds']}s "
+            f"({summary['files_per_second']} files/s, {summary['mb_per_second']} MB/s, {workers} workers)"
+        )
+
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())